@@ -1,5 +1,14 @@
-import tensorflow as tf
-tf.compat.v1.disable_eager_execution()  # Makes TF 2.x behave like TF 1.x
+import numpy as np
+import profiler
+
+
+def tensorflow():
+    # TensorFlow is imported on the first network built, so importing this module
+    # (e.g. from tooling or the API server) stays cheap
+    import tensorflow as tf
+    tf.compat.v1.disable_eager_execution()  # Makes TF 2.x behave like TF 1.x
+    return tf
+
 
 class Qnetwork():
     def __init__(self, s_size, a_size):
@@ -10,6 +19,7 @@ class Qnetwork():
 
 
     def structure(self):
+        tf = tensorflow()
         #init = tf.glorot_normal_initializer()
         init = tf.compat.v1.keras.initializers.glorot_normal()
         #self.input = tf.placeholder(dtype=tf.float32, shape=[None,self.s_size])
@@ -45,3 +55,78 @@ class Qnetwork():
         self.loss = tf.reduce_mean(self.error)
         self.optimizer = tf.compat.v1.train.AdamOptimizer(learning_rate=0.0001)
         self.update = self.optimizer.minimize(self.loss)
+        self.variables = [self.W_1, self.b_1, self.W_2, self.b_2, self.W_3]
+
+    def q_values(self, state):   # the same network as self.action applied to another input
+        tf = tensorflow()
+        inputt = tf.truediv(state,[[180.0,180.0]])
+        h_1 = tf.nn.relu(tf.matmul(inputt, self.W_1) + self.b_1)
+        h_2 = tf.nn.relu(tf.matmul(h_1, self.W_2) + self.b_2)
+        h_2_drop = tf.compat.v1.nn.dropout(h_2, rate=0.25)
+        return tf.matmul(h_2_drop, self.W_3)
+
+
+class DoubleDQN():
+    # The whole Double DQN training step as one op: Qnet picks a' on s', Targetnet
+    # evaluates it, y = r + (1 - d) * gamma * Q_target(s', a') is built in the graph and
+    # Qnet's Adam update runs on (s, a, y). train() is a single sess.run per batch.
+    # The Qnet -> Targetnet copy is built once as well: tau = 1 copies the weights,
+    # tau < 1 moves Targetnet by tau towards Qnet (Polyak averaging).
+    def __init__(self, Qnet, Targetnet, gamma=0.9, tau=1.0):
+        tf = tensorflow()
+        self.Qnet = Qnet
+        self.Targetnet = Targetnet
+        self.gamma = gamma
+        self.tau = tau
+        self.profiler = profiler.disabled   # main.py sets a phase_profiler to time sampling, updates and syncs
+        self.hard_sync = tf.group(*[t.assign(q) for q, t in zip(Qnet.variables, Targetnet.variables)])
+        if tau < 1.0:
+            self.sync = tf.group(*[t.assign(tau * q + (1 - tau) * t) for q, t in zip(Qnet.variables, Targetnet.variables)])
+        else:
+            self.sync = self.hard_sync
+        self.next_input = tf.compat.v1.placeholder(dtype=tf.float32, shape=[None, Qnet.s_size])
+        self.reward = tf.compat.v1.placeholder(dtype=tf.float32, shape=[None])
+        self.done = tf.compat.v1.placeholder(dtype=tf.float32, shape=[None])
+        next_a = tf.argmax(input=Qnet.q_values(self.next_input), axis=1)
+        next_onehot = tf.one_hot(indices=next_a, depth=Qnet.a_size, on_value=1.0, off_value=0.0)
+        next_Q = tf.reduce_sum(tf.multiply(next_onehot, Targetnet.q_values(self.next_input)), axis=1)
+        self.target_y = tf.stop_gradient(self.reward + (1 - self.done) * gamma * next_Q)   # target Q
+        self.td_error = self.target_y - Qnet.Q
+        # importance-sampling weights of a prioritized batch, all ones when not fed
+        self.is_weights = tf.compat.v1.placeholder_with_default(tf.ones_like(self.reward), shape=[None])
+        self.error = self.is_weights * tf.square(self.td_error)
+        self.loss = tf.reduce_mean(self.error)
+        self.update = Qnet.optimizer.minimize(self.loss, var_list=Qnet.variables)   # shares Qnet's Adam slots
+
+    def sync_target(self, sess):   # copy (or soft-update) Qnet weights into Targetnet
+        with self.profiler.phase("target_sync"):
+            sess.run(self.sync)
+
+    def train(self, sess, batch):   # one Adam step on a replay batch, returns the loss
+        ex_s, ex_a, ex_r, ex_s1, ex_d = batch
+        loss, _ = sess.run([self.loss, self.update], feed_dict={
+            self.Qnet.input: ex_s, self.Qnet.a: ex_a, self.reward: ex_r,
+            self.next_input: ex_s1, self.done: ex_d.astype(np.float32)})
+        return loss
+
+    def train_prioritized(self, sess, batch, weights):   # 2 output: loss, TD error per transition
+        ex_s, ex_a, ex_r, ex_s1, ex_d = batch
+        loss, td_error, _ = sess.run([self.loss, self.td_error, self.update], feed_dict={
+            self.Qnet.input: ex_s, self.Qnet.a: ex_a, self.reward: ex_r,
+            self.next_input: ex_s1, self.done: ex_d.astype(np.float32), self.is_weights: weights})
+        return loss, td_error
+
+    def train_from(self, sess, replay_buffer, num):   # sample num transitions and train on them, returns the loss
+        if getattr(replay_buffer, "prioritized", False):
+            with self.profiler.phase("replay_sample"):
+                batch, idx, weights = replay_buffer.sample(num)
+            with self.profiler.phase("tf_update"):
+                loss, td_error = self.train_prioritized(sess, batch, weights)
+            with self.profiler.phase("replay_sample"):
+                replay_buffer.update_priorities(idx, td_error)
+            return loss
+        with self.profiler.phase("replay_sample"):
+            batch = replay_buffer.batch(num)
+        with self.profiler.phase("tf_update"):
+            return self.train(sess, batch)
+
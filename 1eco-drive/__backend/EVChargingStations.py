@@ -1,17 +1,24 @@
-import requests
+import providers
+from stations import parse_station
 
 class EVChargingStations:
-    def __init__(self, api_key):
+    def __init__(self, api_key, store=None):
         self.api_key = api_key
+        self.store = store   # optional charging_station_store answering covered areas locally
 
     def charge_stations_api(self, latitude, longitude, max_results=10, distance=10):  
+        if self.store is not None and self.store.covers((latitude, longitude), distance):
+            self.charge_stations = self.store.within((latitude, longitude), distance, max_results)
+            self.charge_json_status = "OK" if self.charge_stations else "No Data"
+            if self.charge_json_status != "OK":
+                self.charge_stations = "N/A"
+            return self.charge_json_status, self.charge_stations
+
         # Construct the API URL
-        charge_api = "0a679e06-9fa6-4b80-83e1-8abb7f83a6e9"
-        charge_url = f"{charge_api}?key={self.api_key}&latitude={latitude}&longitude={longitude}&maxresults={max_results}&distance={distance}&distanceunit=KM"
+        charge_url = f"https://api.openchargemap.io/v3/poi/?key={self.api_key}&latitude={latitude}&longitude={longitude}&maxresults={max_results}&distance={distance}&distanceunit=KM"
 
         # Send request
-        s = requests.Session()
-        charge_json = s.get(charge_url).json()
+        charge_json = providers.get(charge_url).json()
 
         # Process response
         self.charge_json_status = "OK" if charge_json else "No Data"
@@ -19,16 +26,7 @@ class EVChargingStations:
 
         if self.charge_json_status == "OK":
             for station in charge_json:
-                station_info = {
-                    "Name": station.get("AddressInfo", {}).get("Title", "Unknown"),
-                    "Address": station.get("AddressInfo", {}).get("AddressLine1", "No address"),
-                    "Latitude": station.get("AddressInfo", {}).get("Latitude"),
-                    "Longitude": station.get("AddressInfo", {}).get("Longitude"),
-                    "Usage Type": station.get("UsageType", {}).get("Title", "Unknown"),
-                    "Status": station.get("StatusType", {}).get("Title", "Unknown"),
-                    "Number of Connections": len(station.get("Connections", []))
-                }
-                self.charge_stations.append(station_info)
+                self.charge_stations.append(parse_station(station))
         else:
             self.charge_stations = "N/A"
 
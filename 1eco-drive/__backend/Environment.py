@@ -1,19 +1,57 @@
 from datetime import datetime
 import urllib.parse
 import requests
+import providers
+import metrics
+import profiler
 from haversine import haversine
 from battery import lithium_ion_battery
 from motor import need_energy
+from cache import DirectionsCache, ElevationCache, GeocodingCache
+from stations import charging_station_store, parse_station
 import math
+import numpy as np
+import asyncio
+import threading
 import traceback
 
+# shared by every environment so training episodes and /route requests reuse lookups.
+# The lookup caches are created by the first environment (shared_caches()), not at
+# import, like the regions of station_store, which are read on first use.
+elevation_cache = None
+directions_cache = None
+geocoding_cache = None
+station_store = charging_station_store("stations_cache.db")
+_caches_lock = threading.Lock()
+
+
+def shared_caches():   # 3 output: elevation, directions and geocoding cache
+    global elevation_cache, directions_cache, geocoding_cache
+    with _caches_lock:
+        if elevation_cache is None:
+            elevation_cache = ElevationCache("elevation_cache.db", precision=5)
+            directions_cache = DirectionsCache("directions_cache.db", precision=5)
+            geocoding_cache = GeocodingCache("geocoding_cache.db")
+            metrics.cache_collector("elevation", elevation_cache.stats)
+            metrics.cache_collector("directions", directions_cache.stats)
+            metrics.cache_collector("geocoding", geocoding_cache.stats)
+    return elevation_cache, directions_cache, geocoding_cache
+
+
 class environment():
-    def __init__(self, origin_adr, destination_adr):
+    elevation_url = "https://api.open-elevation.com/api/v1/lookup"
+
+    def __init__(self, origin_adr, destination_adr, build_map=True):
         self.origin = origin_adr
         self.destination = destination_adr
         self.latt = 0
         self.lngg = 0
-        self.make_map()
+        self.elevation_cache, self.directions_cache, self.geocoding_cache = shared_caches()
+        self.station_store = station_store
+        self.table = None   # transition_table for the tabular simulation mode
+        self.profiler = profiler.disabled   # main.py sets a phase_profiler to time the battery/energy simulation
+        if build_map:
+            self.make_map()
         self.battery = lithium_ion_battery(50000) #Wh
         self.need_energy = need_energy()
         self.charge_num = 0
@@ -25,49 +63,84 @@ class environment():
         self.envheightkm = 1
         
 
-    def geocoding_api(self, address):  # 2 output: status, position
+    @classmethod
+    async def create(cls, origin_adr, destination_adr):
+        # asyncio counterpart of environment(origin_adr, destination_adr) that does not block the event loop
+        env = cls(origin_adr, destination_adr, build_map=False)
+        await env.make_map_async()
+        return env
+
+    def geocoding_url(self, address):
         # address: key word of place
         geocode_api = 'pk.47e21dac251393c0ceb955d6836a190e'
         
         # Use the provided address parameter instead of hardcoded value
         encoded_address = urllib.parse.quote(address)
-        geocode_url = f'https://us1.locationiq.com/v1/search?key={geocode_api}&q={encoded_address}&format=json'
-        
-        s = requests.Session()
+        return f'https://us1.locationiq.com/v1/search?key={geocode_api}&q={encoded_address}&format=json'
+
+    def geocoding_api(self, address):  # 2 output: status, position
+        position = self.geocoding_cache.get(address)   # coordinates and known addresses need no request
+        if position is not None:
+            return self.geocoding_found(*position)
         try:
-            response = s.get(geocode_url)
+            response = providers.get(self.geocoding_url(address))
             response.raise_for_status()
             geocode_json = response.json()
-            print("DEBUG: Geocode JSON Response:", geocode_json)
-            
-            # LocationIQ returns a list of results, not a status object
-            if isinstance(geocode_json, list) and len(geocode_json) > 0:
-                self.geocode_json_status = "OK"
-                first_result = geocode_json[0]
-                
-                # Extract latitude and longitude
-                latt = float(first_result.get('lat', 0))
-                lngg = float(first_result.get('lon', 0))
-                
-                self.latt = latt
-                self.lngg = lngg
-                self.geoposition = f"{latt},{lngg}"
-                self.geoposition_tuple = (latt, lngg)
-                
-                return self.geocode_json_status, self.geoposition, self.geoposition_tuple
-            else:
-                self.geocode_json_status = "ZERO_RESULTS"
-                self.geoposition = 'N/A'
-                self.geoposition_tuple = ('g', 'g')
-                return self.geocode_json_status, self.geoposition, self.geoposition_tuple
-                
         except requests.exceptions.RequestException as e:
-            print(f"ERROR: Geocoding request failed - {e}")
-            self.geocode_json_status = "REQUEST_DENIED"
+            return self.geocoding_failed(e)
+        return self.geocoding_parse(geocode_json, address)
+
+    async def geocoding_api_async(self, address):
+        # the cache reads and writes SQLite, so it is used from a worker thread, not on the event loop
+        position = await asyncio.to_thread(self.geocoding_cache.get, address)
+        if position is not None:
+            return self.geocoding_found(*position)
+        try:
+            response = await providers.aget(self.geocoding_url(address))
+            response.raise_for_status()
+            geocode_json = response.json()
+        except requests.exceptions.RequestException as e:
+            return self.geocoding_failed(e)
+        result = self.geocoding_parse(geocode_json)
+        if self.geocode_json_status == "OK":
+            await asyncio.to_thread(self.geocoding_cache.put, address, self.latt, self.lngg)
+        return result
+
+    def geocoding_found(self, latt, lngg):
+        self.geocode_json_status = "OK"
+        self.latt = latt
+        self.lngg = lngg
+        self.geoposition = f"{latt},{lngg}"
+        self.geoposition_tuple = (latt, lngg)
+        return self.geocode_json_status, self.geoposition, self.geoposition_tuple
+
+    def geocoding_parse(self, geocode_json, address=None):
+        print("DEBUG: Geocode JSON Response:", geocode_json)
+        
+        # LocationIQ returns a list of results, not a status object
+        if isinstance(geocode_json, list) and len(geocode_json) > 0:
+            self.geocode_json_status = "OK"
+            first_result = geocode_json[0]
+            
+            # Extract latitude and longitude
+            latt = float(first_result.get('lat', 0))
+            lngg = float(first_result.get('lon', 0))
+            if address is not None:
+                self.geocoding_cache.put(address, latt, lngg)
+            return self.geocoding_found(latt, lngg)
+        else:
+            self.geocode_json_status = "ZERO_RESULTS"
             self.geoposition = 'N/A'
             self.geoposition_tuple = ('g', 'g')
             return self.geocode_json_status, self.geoposition, self.geoposition_tuple
 
+    def geocoding_failed(self, e):
+        print(f"ERROR: Geocoding request failed - {e}")
+        self.geocode_json_status = "REQUEST_DENIED"
+        self.geoposition = 'N/A'
+        self.geoposition_tuple = ('g', 'g')
+        return self.geocode_json_status, self.geoposition, self.geoposition_tuple
+
     def elevation_api(self, location):  # 2 output: elevation, resolution
         # location = '51.4700223,-0.4542955'
         
@@ -77,6 +150,12 @@ class environment():
             return "ERROR", "N/A"
             
         lat, lon = location.split(",")
+
+        cached = self.elevation_cache.get(lat, lon)
+        if cached is not None:
+            self.elevation_json_status = "OK"
+            self.elevation_data_results_elevation = cached
+            return self.elevation_json_status, self.elevation_data_results_elevation
         
         # Open-Elevation API expects a POST request with JSON payload
         elevation_url = "https://api.open-elevation.com/api/v1/lookup"
@@ -90,8 +169,7 @@ class environment():
         }
         
         try:
-            s = requests.Session()
-            response = s.post(elevation_url, json=payload)
+            response = providers.post(elevation_url, json=payload)
             response.raise_for_status()
             elevation_json = response.json()
             
@@ -99,6 +177,7 @@ class environment():
                 self.elevation_json_status = "OK"
                 self.elevation_data_results_elevation = elevation_json["results"][0]["elevation"]
                 elevation_data_results_resolution = 30  # Default resolution for open-elevation
+                self.elevation_cache.put(lat, lon, self.elevation_data_results_elevation)
                 return self.elevation_json_status, self.elevation_data_results_elevation
             else:
                 self.elevation_json_status = "NO_RESULTS"
@@ -111,20 +190,158 @@ class environment():
             self.elevation_data_results_elevation = 'N/A'
             return self.elevation_json_status, self.elevation_data_results_elevation
 
+    def elevation_bulk_api(self, locations, chunk_size=100):  # 2 output: status, {(lat, lng): elevation}
+        # locations: list of (lat, lng); every unique point is fetched once,
+        # cached points are skipped and the rest are sent in chunked POSTs
+        elevations, chunks = self.elevation_chunks(locations, chunk_size)
+        status = "OK"
+        for chunk in chunks:
+            try:
+                response = providers.post(self.elevation_url, json=self.elevation_payload(chunk))
+                response.raise_for_status()
+                elevation_json = response.json()
+            except requests.exceptions.RequestException as e:
+                print(f"ERROR: Elevation request failed - {e}")
+                status = "REQUEST_DENIED"
+                continue
+            chunk_status = self.elevation_store(chunk, elevation_json, elevations)
+            status = chunk_status if chunk_status != "OK" else status
+
+        self.elevation_json_status = status
+        return status, elevations
+
+    async def elevation_bulk_api_async(self, locations, chunk_size=100, concurrency=8):
+        # same as elevation_bulk_api with up to `concurrency` chunk POSTs in flight; the
+        # cache lookups (one batch per call) and stores run in worker threads
+        elevations, chunks = await asyncio.to_thread(self.elevation_chunks, locations, chunk_size)
+        limit = asyncio.Semaphore(concurrency)
+
+        async def fetch(chunk):
+            async with limit:
+                try:
+                    response = await providers.apost(self.elevation_url, json=self.elevation_payload(chunk))
+                    response.raise_for_status()
+                    elevation_json = response.json()
+                except requests.exceptions.RequestException as e:
+                    print(f"ERROR: Elevation request failed - {e}")
+                    return "REQUEST_DENIED"
+            return await asyncio.to_thread(self.elevation_store, chunk, elevation_json, elevations)
+
+        statuses = await asyncio.gather(*[fetch(chunk) for chunk in chunks])
+        status = next((s for s in statuses if s != "OK"), "OK")
+        self.elevation_json_status = status
+        return status, elevations
+
+    def elevation_payload(self, chunk):
+        return {"locations": [{"latitude": lat, "longitude": lng} for lat, lng in chunk]}
+
+    def elevation_chunks(self, locations, chunk_size):  # 2 output: cached {(lat, lng): elevation}, chunks to fetch
+        elevations = {}
+        missing = []
+        seen = set()
+        for location in locations:
+            point = (float(location[0]), float(location[1]))
+            if point in seen:
+                continue
+            seen.add(point)
+            cached = self.elevation_cache.get(point[0], point[1])
+            if cached is not None:
+                elevations[point] = cached
+            else:
+                missing.append(point)
+        return elevations, [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+
+    def elevation_store(self, chunk, elevation_json, elevations):
+        results = elevation_json.get("results", [])
+        if len(results) != len(chunk):
+            return "NO_RESULTS"
+        fetched = [(lat, lng, result["elevation"]) for (lat, lng), result in zip(chunk, results)]
+        for lat, lng, elevation in fetched:
+            elevations[(lat, lng)] = elevation
+        self.elevation_cache.put_many(fetched)
+        return "OK"
+
+    def step_elevations(self, leg_step):  # [(height_start, height_end)] for every step
+        points = self.step_points(leg_step)
+        status, elevations = self.elevation_bulk_api(points)
+        retry_count = 0
+        while status != 'OK' and retry_count < 3:
+            status, fetched = self.elevation_bulk_api([p for p in points if p not in elevations])
+            elevations.update(fetched)
+            retry_count += 1
+        return self.step_heights(points, elevations)
+
+    async def step_elevations_async(self, leg_step):
+        points = self.step_points(leg_step)
+        status, elevations = await self.elevation_bulk_api_async(points)
+        retry_count = 0
+        while status != 'OK' and retry_count < 3:
+            status, fetched = await self.elevation_bulk_api_async([p for p in points if p not in elevations])
+            elevations.update(fetched)
+            retry_count += 1
+        return self.step_heights(points, elevations)
+
+    def step_points(self, leg_step):  # start and end (lat, lng) of every step, interleaved
+        points = []
+        for step in leg_step:
+            points.append((float(step['start_location']['lat']), float(step['start_location']['lng'])))
+            points.append((float(step['end_location']['lat']), float(step['end_location']['lng'])))
+        return points
+
+    def step_heights(self, points, elevations):
+        heights = []
+        for i in range(len(points) // 2):
+            start, end = points[2 * i], points[2 * i + 1]
+            if start in elevations and end in elevations:
+                heights.append((elevations[start], elevations[end]))
+            else:
+                print(f"WARNING: Could not get elevation data after multiple attempts")
+                heights.append((0, 0))
+        return heights
+
     def directions_api(self, origin, destination):
         """Fetches driving directions between two locations using the LocationIQ API."""
+        directions_url, result = self.directions_request(origin, destination)
+        if directions_url is None:
+            return result
 
+        # Make API request
+        try:
+            response = providers.get(directions_url)
+            response.raise_for_status()  # Raise an error for HTTP status codes
+            directions_json = response.json()
+        except requests.exceptions.RequestException as e:
+            print(f"ERROR: Request failed - {e}")
+            return None, None, None
+        return self.directions_parse(directions_json, origin, destination)
+
+    async def directions_api_async(self, origin, destination):
+        # cache lookup and store in worker threads, like the geocoding and elevation caches
+        directions_url, result = await asyncio.to_thread(self.directions_request, origin, destination)
+        if directions_url is None:
+            return result
+
+        try:
+            response = await providers.aget(directions_url)
+            response.raise_for_status()
+            directions_json = response.json()
+        except requests.exceptions.RequestException as e:
+            print(f"ERROR: Request failed - {e}")
+            return None, None, None
+        return await asyncio.to_thread(self.directions_parse, directions_json, origin, destination)
+
+    def directions_request(self, origin, destination):  # 2 output: url to fetch or None, result when there is nothing to fetch
         print(f"DEBUG: Origin received in directions_api: {origin}")
         print(f"DEBUG: Destination received in directions_api: {destination}")
 
         # Validate input
         if not origin or not destination:
             print("ERROR: One of the locations is missing!")
-            return None, None, None
+            return None, (None, None, None)
 
         if "," not in origin or "," not in destination:
             print("ERROR: Origin or destination is not in 'lat,lon' format!")
-            return None, None, None
+            return None, (None, None, None)
 
         # Parse latitude and longitude
         try:
@@ -136,7 +353,15 @@ class environment():
             float(destination_lat), float(destination_lon)
         except (ValueError, TypeError):
             print("ERROR: Invalid coordinate format received.")
-            return None, None, None
+            return None, (None, None, None)
+
+        # Grid transitions repeat across episodes, so answer them locally when possible
+        cached_steps, cached_bound = self.directions_cache.get((origin_lat, origin_lon), (destination_lat, destination_lon))
+        if cached_steps is not None:
+            self.directions_data_routes_legs_steps = cached_steps
+            self.bound = cached_bound
+            self.directions_json_status = "OK"
+            return None, (self.directions_json_status, self.directions_data_routes_legs_steps, self.bound)
 
         # Convert to 'lon,lat' format required by the API
         origin_fixed = f"{origin_lon},{origin_lat}"
@@ -152,15 +377,11 @@ class environment():
         )
 
         print(f"DEBUG: Requesting directions from API: {directions_url}")
+        return directions_url, None
 
-        # Make API request
-        try:
-            response = requests.get(directions_url)
-            response.raise_for_status()  # Raise an error for HTTP status codes
-            directions_json = response.json()
-        except requests.exceptions.RequestException as e:
-            print(f"ERROR: Request failed - {e}")
-            return None, None, None
+    def directions_parse(self, directions_json, origin, destination):
+        origin_lat, origin_lon = origin.split(",")
+        destination_lat, destination_lon = destination.split(",")
 
         # Validate response structure
         if not directions_json.get("routes"):
@@ -234,6 +455,8 @@ class environment():
             }
 
             self.directions_json_status = "OK"  # Mark as successful
+            self.directions_cache.put((origin_lat, origin_lon), (destination_lat, destination_lon),
+                                      self.directions_data_routes_legs_steps, self.bound)
             return self.directions_json_status, self.directions_data_routes_legs_steps, self.bound
 
         except (KeyError, IndexError) as e:
@@ -241,26 +464,23 @@ class environment():
             return None, None, None
 
     def chargingstation_api(self, latitude, longitude, max_results=10, distance=10):
+        # answered from the local station store when a loaded region covers the search circle
+        if self.station_store.covers((latitude, longitude), distance):
+            self.charge_stations = self.station_store.within((latitude, longitude), distance, max_results)
+            self.charge_json_status = "OK" if self.charge_stations else "No Data"
+            if self.charge_json_status != "OK":
+                self.charge_stations = "N/A"
+            return self.charge_json_status, self.charge_stations
+
         charge_api = "0a679e06-9fa6-4b80-83e1-8abb7f83a6e9"
         charge_url = f"https://api.openchargemap.io/v3/poi/?key={charge_api}&latitude={latitude}&longitude={longitude}&maxresults={max_results}&distance={distance}&distanceunit=KM"
-        s = requests.Session()
         try:
-            charge_json = s.get(charge_url).json()
+            charge_json = providers.get(charge_url).json()
             self.charge_json_status = "OK" if charge_json else "No Data"
             self.charge_stations = []
 
             if self.charge_json_status == "OK":
-                for station in charge_json:
-                    station_info = {
-                        "Name": station.get("AddressInfo", {}).get("Title", "Unknown"),
-                        "Address": station.get("AddressInfo", {}).get("AddressLine1", "No address"),
-                        "Latitude": station.get("AddressInfo", {}).get("Latitude"),
-                        "Longitude": station.get("AddressInfo", {}).get("Longitude"),
-                        "Usage Type": station.get("UsageType", {}).get("Title", "Unknown"),
-                        "Status": station.get("StatusType", {}).get("Title", "Unknown"),
-                        "Number of Connections": len(station.get("Connections", []))
-                    }
-                    self.charge_stations.append(station_info)
+                self.charge_stations = [parse_station(station) for station in charge_json]
             else:
                 self.charge_stations = "N/A"
 
@@ -268,6 +488,12 @@ class environment():
         except requests.exceptions.RequestException as e:
             return "Request Error", str(e)
 
+    def load_stations(self, bound=None):  # bulk-load the charging stations of the map (or bound) into the store
+        bound = self.map_bound if bound is None else bound
+        if bound is None:   # no directions, so no map
+            return None
+        return self.station_store.load(bound)
+
     def make_map(self):
         print("DEBUG: Entering make_map()")
         origin_status, origin_position, origin_position_num = self.geocoding_api(self.origin)
@@ -279,7 +505,6 @@ class environment():
             destination_position_num = (self.latt, self.lngg)
 
         direction_status, direction_step, self.map_bound = self.directions_api(origin_position, destination_position)
-        self.Google_step = direction_step
         
         # Retry up to 3 times if directions API fails
         retry_count = 0
@@ -288,6 +513,38 @@ class environment():
             direction_status, direction_step, self.map_bound = self.directions_api(origin_position, destination_position)
             retry_count += 1
             
+        self.set_map(direction_status, direction_step, origin_position_num, destination_position_num)
+
+    async def make_map_async(self):
+        origin_position, destination_position = await self.geocode_async()
+        await self.directions_map_async(origin_position, destination_position)
+
+    async def directions_map_async(self, origin_position, destination_position):  # the route between geocode_async()'s positions
+        direction_status, direction_step, self.map_bound = await self.directions_api_async(origin_position, destination_position)
+        retry_count = 0
+        while direction_status != 'OK' and retry_count < 3:
+            print(f"Retrying directions API, attempt {retry_count + 1}")
+            direction_status, direction_step, self.map_bound = await self.directions_api_async(origin_position, destination_position)
+            retry_count += 1
+
+        self.set_map(direction_status, direction_step, self.start_position, self.end_position)
+
+    async def geocode_async(self):  # 2 output: origin and destination as "lat,lng", positions set on self
+        # geocodes origin and destination concurrently, cached addresses need no request
+        (origin_status, origin_position, origin_position_num), (destination_status, destination_position, destination_position_num) = \
+            await asyncio.gather(self.geocoding_api_async(self.origin), self.geocoding_api_async(self.destination))
+        # keep the fallbacks of the sequential make_map
+        if origin_position_num == ('g','g'):
+            origin_position_num = (0, 0)
+        if destination_position_num == ('g','g'):
+            destination_position_num = origin_position_num
+        self.latt, self.lngg = destination_position_num
+        self.current_position = self.start_position = origin_position_num
+        self.end_position = destination_position_num
+        return origin_position, destination_position
+
+    def set_map(self, direction_status, direction_step, origin_position_num, destination_position_num):
+        self.Google_step = direction_step
         if direction_status != 'OK':
             print("WARNING: Could not get directions after multiple attempts")
             
@@ -318,9 +575,70 @@ class environment():
         self.stride_height = (north - south) / (height * self.length)  # positive   # 500m per stride
         self.stride_wide = (east - west) / (wide * self.length)
 
+    def leg_segments(self, leg_step, heights=None):  # [start, end, duration, distance, angle, speed, power] for every step
+        # heights: (height_start, height_end) per step when they are already known
+        if heights is None:
+            heights = self.step_elevations(leg_step)
+        if not leg_step:
+            return []
+        starts = [(step['start_location']['lat'], step['start_location']['lng']) for step in leg_step]
+        ends = [(step['end_location']['lat'], step['end_location']['lng']) for step in leg_step]
+        durations = [step['duration']['value'] for step in leg_step]  # second
+        durations = [duration if duration > 0 else 1 for duration in durations]
+        distances = [step['distance']['value'] for step in leg_step]  # km
+
+        # the whole leg goes through the motor model in one call
+        distance = np.array(distances, dtype=np.float64)
+        elevation = np.array([height_end - height_start for height_start, height_end in heights], dtype=np.float64)  # unit: m
+        speed = np.sqrt(distance ** 2 + elevation ** 2) / np.array(durations, dtype=np.float64)  # m/s
+        angle = np.arctan2(distance * 1000, elevation)   # degree
+        angle = np.where(angle > 0, angle, 0)   # we let downard as flat
+        power = self.need_energy.energy_array(angle, speed)
+        return [[starts[i], ends[i], durations[i], distances[i], float(angle[i]), float(speed[i]), float(power[i])]
+                for i in range(len(leg_step))]
+
+    def use_table(self, table):
+        # tabular simulation mode: step() reads the precomputed transitions and makes no HTTP calls.
+        # None switches back to the live APIs
+        self.table = table
+        self.stride_length(self.start_position)
+        if table is not None:
+            self.stride_height, self.stride_wide = table.stride
+
+    def table_step(self, action):
+        table = self.table
+        self.step_reward = 0
+        current_status = False
+        self.status_dir_check = 'OK'
+        cell = table.cell_of(self.current_position)
+        t = table.index(cell, action)
+        if t is None or not table.reachable[t]:
+            self.step_reward = -1
+            self.unreach_position_num = self.unreach_position_num + 1
+            self.next_position = self.current_position
+        else:
+            self.step_reward = 0.9 if table.goal[t] else -0.1
+            durations, powers, scored = table.segments(t)
+            with self.profiler.phase("simulation"):
+                for duration, power, score in zip(durations, powers, scored):
+                    self.time = self.time + duration
+                    charge, energy_consume, penalty, _ = self.battery.use_segment(duration=duration, power=power)
+                    if score:
+                        self.step_reward -= penalty
+                    self.charge_num += charge
+            current_status = bool(table.goal[t])
+            self.next_position = table.position(table.next_cell(cell, action))
+
+        self.current_step_history = []
+        self.current_position = self.next_position
+        batterySOC = self.battery.SOC
+        return self.current_position, self.step_reward, current_status, self.charge_num, batterySOC
+
     def step(self, action):  # output:
         # action is in the set of (0,1,2,3) = (north, east, south, west)
         # self.current_position is tuple (lat, lng)
+        if self.table is not None:
+            return self.table_step(action)
         self.step_reward = 0
         current_status = False
         step_history = []
@@ -355,55 +673,24 @@ class environment():
             if status != 'OVER_QUERY_LIMIT':
                 self.step_reward = -1
                 self.unreach_position_num = self.unreach_position_num + 1
+            else:
+                metrics.over_query_limit.inc()
             self.next_position = self.current_position  # Revert to previous position
         else:
             self.step_reward -= 0.1    # get -0.1 reward for every transition
             
             # Process each step of the leg
-            for i in range(len(leg_step)):
-                start = (leg_step[i]['start_location']['lat'],leg_step[i]['start_location']['lng'])
-                end = (leg_step[i]['end_location']['lat'],leg_step[i]['end_location']['lng'])
-                duration = leg_step[i]['duration']['value']  # second
-                distance = leg_step[i]['distance']['value']  # km
-                start_position = f"{start[0]},{start[1]}"
-                end_position = f"{end[0]},{end[1]}"
-                
-                # Get elevation data
-                status, height_start = self.elevation_api(start_position)
-                status1, height_end = self.elevation_api(end_position)
-                
-                retry_count = 0
-                while (status != 'OK' or status1 != 'OK') and retry_count < 3:
-                    status, height_start = self.elevation_api(start_position)
-                    status1, height_end = self.elevation_api(end_position)
-                    retry_count += 1
-                
-                if status != 'OK' or status1 != 'OK':
-                    print(f"WARNING: Could not get elevation data after multiple attempts")
-                    height_start = 0
-                    height_end = 0
-                
-                elevation = height_end - height_start  # unit: m
-                if duration <= 0:
-                    duration = 1
-                    
-                self.time = self.time + duration
-                speed = math.sqrt(distance ** 2 + elevation ** 2) / duration  # m/s
-                angle = math.atan2(distance * 1000, elevation)   # degree
-                angle = angle if angle > 0 else 0
-                power = self.need_energy.energy(angle=angle, V=speed)
-                energy_consume = 0
-                
-                # Simulate energy consumption over time
-                for t in range(int(duration)):
-                    charge = self.battery.use(duration=1, power=power)
-                    energy_consume += self.battery.energy_consume
-                    self.step_reward -= self.battery.energy_consume/100000
-                    if charge:   # this duration need to charge the battery
-                        self.charge_num += 1
-                        self.battery.charge(50000)    # make it full capacity
-
-                step_history.append([start, end, duration, distance, angle, speed, energy_consume])
+            heights = self.step_elevations(leg_step)
+            with self.profiler.phase("simulation"):
+                for start, end, duration, distance, angle, speed, power in self.leg_segments(leg_step, heights):
+                    self.time = self.time + duration
+
+                    # Simulate energy consumption over time
+                    charge, energy_consume, penalty, _ = self.battery.use_segment(duration=duration, power=power)
+                    self.step_reward -= penalty
+                    self.charge_num += charge    # recharged to full capacity each time
+
+                    step_history.append([start, end, duration, distance, angle, speed, energy_consume])
             
             # Check if we're close to the destination
             if (abs(self.next_position[0] - self.end_position[0]) < self.stride_height and 
@@ -418,46 +705,13 @@ class environment():
                 self.legE = leg_stepE
                 
                 if statusE == 'OK':
-                    for i in range(len(self.legE)):
-                        start = (self.legE[i]['start_location']['lat'], self.legE[i]['start_location']['lng'])
-                        end = (self.legE[i]['end_location']['lat'], self.legE[i]['end_location']['lng'])
-                        duration = self.legE[i]['duration']['value']  # second
-                        distance = self.legE[i]['distance']['value']  # km
-                        start_position = f"{start[0]},{start[1]}"
-                        end_position = f"{end[0]},{end[1]}"
-                        
-                        status, height_start = self.elevation_api(start_position)
-                        status1, height_end = self.elevation_api(end_position)
-                        
-                        retry_count = 0
-                        while (status != 'OK' or status1 != 'OK') and retry_count < 3:
-                            status, height_start = self.elevation_api(start_position)
-                            status1, height_end = self.elevation_api(end_position)
-                            retry_count += 1
-                            
-                        if status != 'OK' or status1 != 'OK':
-                            print(f"WARNING: Could not get elevation data after multiple attempts")
-                            height_start = 0
-                            height_end = 0
-                            
-                        elevation = height_end - height_start  # unit: m
-                        if duration <= 0:
-                            duration = 1
-                            
-                        self.time = self.time + duration
-                        speed = math.sqrt(distance ** 2 + elevation ** 2) / duration  # m/s
-                        angle = math.atan2(distance * 1000, elevation)   # degree
-                        angle = angle if angle > 0 else 0   # we let downard as flat
-                        power = self.need_energy.energy(angle=angle, V=speed)
-                        energy_consume = 0
-                        
-                        for t in range(duration):
-                            charge = self.battery.use(duration=1, power=power)
-                            energy_consume += self.battery.energy_consume
-                            self.step_reward -= self.battery.energy_consume/100000
-                            if charge:   # this duration need to charge the battery
-                                self.charge_num += 1
-                                self.battery.charge(50000)    # make it full capacity
+                    heightsE = self.step_elevations(self.legE)
+                    with self.profiler.phase("simulation"):
+                        for start, end, duration, distance, angle, speed, power in self.leg_segments(self.legE, heightsE):
+                            self.time = self.time + duration
+                            charge, energy_consume, penalty, _ = self.battery.use_segment(duration=duration, power=power)
+                            self.step_reward -= penalty
+                            self.charge_num += charge    # recharged to full capacity each time
                 current_status = True
                 self.current_position = self.start_position
 
@@ -466,7 +720,12 @@ class environment():
         batterySOC = self.battery.SOC
         return self.current_position, self.step_reward, current_status, self.charge_num, batterySOC
 
-    def origine_map_reward(self):  # to get the step_reward, chargenum, SOC, time which the route google provided
+    async def origine_map_reward_async(self):
+        # fetches the route elevations concurrently; the battery simulation itself is CPU only
+        heights = await self.step_elevations_async(self.Google_step) if self.Google_step else None
+        return self.origine_map_reward(heights)
+
+    def origine_map_reward(self, heights=None):  # to get the step_reward, chargenum, SOC, time which the route google provided
         leg = self.Google_step
         step_reward = 0
         time = 0
@@ -475,46 +734,11 @@ class environment():
             print("WARNING: No route steps available")
             return 0, 0, self.battery.SOC, 0
             
-        for i in range(len(leg)):
-            start = (leg[i]['start_location']['lat'],leg[i]['start_location']['lng'])
-            end = (leg[i]['end_location']['lat'],leg[i]['end_location']['lng'])
-            duration = leg[i]['duration']['value']  # second
-            distance = leg[i]['distance']['value']  # km
-            start_position = f"{start[0]},{start[1]}"
-            end_position = f"{end[0]},{end[1]}"
-            
-            status, height_start = self.elevation_api(start_position)
-            status1, height_end = self.elevation_api(end_position)
-            
-            retry_count = 0
-            while (status != 'OK' or status1 != 'OK') and retry_count < 3:
-                status, height_start = self.elevation_api(start_position)
-                status1, height_end = self.elevation_api(end_position)
-                retry_count += 1
-                
-            if status != 'OK' or status1 != 'OK':
-                print(f"WARNING: Could not get elevation data after multiple attempts")
-                height_start = 0
-                height_end = 0
-                
-            elevation = height_end - height_start  # unit: m
-            if duration <= 0:
-                duration = 1
-                
+        for start, end, duration, distance, angle, speed, power in self.leg_segments(leg, heights):
             time = time + duration
-            speed = math.sqrt(distance ** 2 + elevation ** 2) / duration  # m/s
-            angle = math.atan2(distance * 1000, elevation)   # degree
-            angle = angle if angle > 0 else 0
-            power = self.need_energy.energy(angle=angle, V=speed)
-            energy_consume = 0
-            
-            for t in range(int(duration)):
-                charge = self.battery.use(duration=1, power=power)
-                energy_consume += self.battery.energy_consume
-                step_reward -= self.battery.energy_consume/100000
-                if charge:   # this duration need to charge the battery
-                    self.charge_num += 1
-                    self.battery.charge(50000)    # make it full capacity
+            charge, energy_consume, penalty, _ = self.battery.use_segment(duration=duration, power=power)
+            step_reward -= penalty
+            self.charge_num += charge    # recharged to full capacity each time
                     
         chargenum = self.charge_num
         SOC = self.battery.SOC
@@ -0,0 +1,157 @@
+import multiprocessing as mp
+import queue
+import numpy as np
+from Environment import environment
+from transition_table import transition_table
+from replay_buffer import transition_dtype
+
+# Qnetwork's trainable variables in order: w1, b1, w2, b2, w3
+def policy_shapes(s_size = 2, a_size = 4):
+    return [(s_size, 10), (10,), (10, 6), (6,), (6, a_size)]
+
+
+def unflatten(flat, shapes):
+    weights, k = [], 0
+    for shape in shapes:
+        n = int(np.prod(shape))
+        weights.append(flat[k:k + n].reshape(shape))
+        k += n
+    return weights
+
+
+def greedy_actions(weights, states):   # Qnetwork.predict in NumPy, without dropout
+    w1, b1, w2, b2, w3 = weights
+    x = np.asarray(states, dtype=np.float32) / 180.0
+    h_1 = np.maximum(x @ w1 + b1, 0)
+    h_2 = np.maximum(h_1 @ w2 + b2, 0)
+    return np.argmax(h_2 @ w3, axis=1)
+
+
+def run_actor(actor_id, route, transitions, weights, version, epsilon, stop, max_step, send_every=32):
+    # Actor process: its own environment, an epsilon-greedy NumPy copy of Qnet and
+    # batches of transition records pushed to the learner. No TensorFlow in here.
+    origin, destination, length, table_path = route
+    env = environment(origin, destination)
+    env.length = length
+    if table_path is not None:
+        env.use_table(transition_table.load(table_path))
+    shapes = policy_shapes()
+    rng = np.random.default_rng()
+    policy, local_version = None, -1
+    dtype = transition_dtype()
+    pending = []
+    while not stop.is_set():
+        env.current_position = env.start_position
+        env.battery_charge()
+        env.charge_num = 0
+        env.unreach_position_num = 0
+        env.time = 0
+        for _ in range(max_step):
+            if version.value != local_version:
+                with weights.get_lock():
+                    flat = np.frombuffer(weights.get_obj(), dtype=np.float32).copy()
+                    local_version = version.value
+                policy = unflatten(flat, shapes)
+            s = np.array(env.current_position, dtype=np.float32)
+            if policy is None or rng.random() < epsilon.value:
+                action = int(rng.integers(0, 4))
+            else:
+                action = int(greedy_actions(policy, [s])[0])
+            s1, r, d, _, _ = env.step(action)
+            if env.status_dir_check != 'OVER_QUERY_LIMIT':
+                pending.append((s, action, r, s1, d))
+            if len(pending) >= send_every:
+                transitions.put(np.array(pending, dtype=dtype))
+                pending = []
+            if d or stop.is_set():
+                break
+    if pending:
+        transitions.put(np.array(pending, dtype=dtype))
+    print("actor", actor_id, "stopped")
+
+
+class actor_pool():
+    # num_actors processes running run_actor against the same route. The learner
+    # drains their transitions into its replay buffer and publishes Qnet weights
+    # into one shared float32 array; actors pick up a new copy when `version` moves.
+    # Processes are forked, so start() must run before the TensorFlow session exists.
+    def __init__(self, num_actors, route, max_step, s_size = 2, a_size = 4, send_every = 32, context = "fork"):
+        ctx = mp.get_context(context)
+        self.shapes = policy_shapes(s_size, a_size)
+        self.transitions = ctx.Queue(maxsize=1024)
+        self.weights = ctx.Array('f', sum(int(np.prod(shape)) for shape in self.shapes))
+        self.version = ctx.Value('i', -1)
+        self.epsilon = ctx.Value('d', 1.0)
+        self.stop = ctx.Event()
+        self.processes = [
+            ctx.Process(target=run_actor, daemon=True,
+                        args=(i, route, self.transitions, self.weights, self.version, self.epsilon, self.stop, max_step, send_every))
+            for i in range(num_actors)
+        ]
+
+    def start(self):
+        for p in self.processes:
+            p.start()
+
+    def publish(self, sess, Qnet):   # broadcast the current Qnet weights to every actor
+        values = sess.run([Qnet.W_1, Qnet.b_1, Qnet.W_2, Qnet.b_2, Qnet.W_3])
+        flat = np.concatenate([np.ravel(v) for v in values]).astype(np.float32)
+        with self.weights.get_lock():
+            np.frombuffer(self.weights.get_obj(), dtype=np.float32)[:] = flat
+            self.version.value += 1
+
+    def drain(self, replay_buffer, timeout = None):   # number of transitions moved into the buffer
+        received = 0
+        block = timeout is not None
+        while True:
+            try:
+                records = self.transitions.get(block=block, timeout=timeout)
+            except queue.Empty:
+                return received
+            replay_buffer.extend(records)
+            received += len(records)
+            block = False
+
+    def close(self, replay_buffer = None):
+        self.stop.set()
+        # keep draining so no actor blocks on a full queue while exiting
+        while any(p.is_alive() for p in self.processes):
+            if replay_buffer is not None:
+                self.drain(replay_buffer, timeout=0.1)
+            else:
+                try:
+                    self.transitions.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        for p in self.processes:
+            p.join()
+
+
+def run_learner(sess, Qnet, trainer, pool, replay_buffer, updates, batch_num = 32,
+                updata_f = 5, broadcast_f = 50, e = 1.0, low_prob = 0.1, slope = 0.0, on_update = None):
+    # Central learner: trains Qnet continuously on whatever the actors have sent so
+    # far, copies it into Targetnet every updata_f updates and broadcasts it to the
+    # actors every broadcast_f updates. Returns the loss of every update.
+    pool.epsilon.value = e
+    pool.publish(sess, Qnet)
+    losses = []
+    while len(losses) < updates:
+        pool.drain(replay_buffer)
+        if len(replay_buffer) <= batch_num:
+            if not any(p.is_alive() for p in pool.processes):
+                pool.drain(replay_buffer)   # whatever they sent before exiting
+                if len(replay_buffer) <= batch_num:
+                    raise RuntimeError("every actor process has exited before filling the replay buffer")
+            pool.drain(replay_buffer, timeout=1.0)
+            continue
+        losses.append(trainer.train_from(sess, replay_buffer, batch_num))
+        step = len(losses)
+        if pool.epsilon.value > low_prob:
+            pool.epsilon.value = max(low_prob, pool.epsilon.value - slope)
+        if step % updata_f == 0:
+            trainer.sync_target(sess)
+        if step % broadcast_f == 0:
+            pool.publish(sess, Qnet)
+        if on_update is not None:
+            on_update(step, losses[-1])
+    return losses
@@ -1,7 +1,12 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
+import collections
 import logging
-from fastapi.responses import FileResponse
+import os
+import threading
+import time
+from fastapi.responses import FileResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 
 # ✅ Initialize FastAPI first
@@ -28,43 +33,198 @@ logger = logging.getLogger(__name__)
 
 # ✅ Import Environment module safely
 try:
-    from Environment import environment  # Ensure Environment.py exists
+    from Environment import environment, station_store  # Ensure Environment.py exists
+    import providers
+    from policy_service import find_checkpoint, load_weights, policy_batcher, policy_rollout
+    from routing import route_graph, OBJECTIVES
+    from cache import ResponseCache, normalize_place
+    import metrics
 except ImportError:
     logger.error("Failed to import Environment module. Make sure Environment.py exists.")
     raise ImportError("Module 'Environment' not found. Check the file path.")
 
+# ✅ Trained policy for /policy-route. Startup only looks for the checkpoint; the weights
+# (and TensorFlow, which reads them) are loaded on the first /policy-route request
+policy = None
+policy_checkpoint = None
+policy_lock = asyncio.Lock()
+POLICY_MAX_BATCH = int(os.environ.get("EVDRIVE_POLICY_MAX_BATCH", "64"))
+POLICY_MAX_WAIT = float(os.environ.get("EVDRIVE_POLICY_MAX_WAIT", "0.002"))   # seconds
+POLICY_MAX_STEP = int(os.environ.get("EVDRIVE_POLICY_MAX_STEP", "500"))   # upper bound of /policy-route?max_step
+
+@app.on_event("startup")
+async def find_policy():
+    global policy_checkpoint
+    policy_checkpoint = find_checkpoint()
+    if policy_checkpoint is None:
+        logger.warning("No Qnetwork checkpoint found, /policy-route is disabled.")
+        return
+    logger.info(f"Found policy checkpoint {policy_checkpoint}, loaded on first use")
+
+async def get_policy():
+    global policy
+    if policy is None and policy_checkpoint is not None:
+        async with policy_lock:   # concurrent first requests share one load
+            if policy is None:
+                weights = await asyncio.to_thread(load_weights, policy_checkpoint)
+                policy = policy_batcher(weights, max_batch=POLICY_MAX_BATCH, max_wait=POLICY_MAX_WAIT)
+                logger.info(f"Loaded policy checkpoint {policy_checkpoint}")
+    return policy
+
+# ✅ /route results by normalized origin/destination; concurrent identical requests share one computation
+route_cache = ResponseCache(maxsize=int(os.environ.get("EVDRIVE_ROUTE_CACHE_SIZE", "1024")),
+                            ttl=float(os.environ.get("EVDRIVE_ROUTE_CACHE_TTL", "300")))   # seconds
+metrics.cache_collector("route", route_cache.stats)
+
+# ✅ Latency of every API request, labelled with the route template so /route?... stays one series
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        metrics.http_latency.observe(time.perf_counter() - start, path, status)
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# ✅ Road graph for energy/time-optimal routes, built from the directions cache in the background.
+# It is only extended and searched in worker threads, one at a time. A failed build is logged
+# and retried; routes fetched meanwhile are kept (step lists only, the newest ones) until it is ready
+road_graph = None
+graph_lock = threading.Lock()
+GRAPH_RETRY_S = float(os.environ.get("EVDRIVE_GRAPH_RETRY", "60"))   # seconds between build attempts
+pending_routes = collections.deque(maxlen=int(os.environ.get("EVDRIVE_GRAPH_PENDING", "1000")))   # (steps, map bound)
+
+def build_road_graph():
+    global road_graph
+    station_store.ensure_loaded()   # read the saved station regions here rather than at import
+    env = environment(None, None, build_map=False)
+    graph = route_graph.build(env)
+    with graph_lock:
+        while pending_routes:
+            extend_graph(graph, env, *pending_routes.popleft())
+        road_graph = graph
+    logger.info(f"Road graph ready: {len(graph.nodes)} nodes, {sum(len(e) for e in graph.edges)} edges")
+
+def start_graph_build(loop):
+    loop.run_in_executor(None, build_road_graph).add_done_callback(lambda done: graph_build_done(loop, done))
+
+def graph_build_done(loop, future):
+    if future.cancelled() or future.exception() is None:
+        return
+    logger.error(f"Road graph build failed, retrying in {GRAPH_RETRY_S:g} s: {future.exception()!r}")
+    loop.call_later(GRAPH_RETRY_S, start_graph_build, loop)
+
+def extend_graph(graph, env, steps, bound):   # a fetched route plus the loaded charging stations of its map
+    graph.add_route(env, steps)
+    if bound is not None:
+        for station in env.station_store.in_bound(bound):
+            graph.add_station(env, station)
+
+def graph_route(env, objective):   # blocking A*, None until the graph is built or when it does not cover both ends
+    with graph_lock:
+        if road_graph is None:
+            return None
+        return road_graph.route(env.start_position, env.end_position, objective)
+
+def optimal_route(env, objective):   # blocking: station load, elevation lookups and A*
+    if env.map_bound is not None:   # None when LocationIQ had no route
+        env.load_stations()   # one bulk request per new map region, outside the graph lock
+    with graph_lock:
+        if road_graph is None:
+            pending_routes.append((env.Google_step, env.map_bound))
+            return None
+        extend_graph(road_graph, env, env.Google_step, env.map_bound)
+        return road_graph.route(env.start_position, env.end_position, objective)
+
+@app.on_event("startup")
+async def start_road_graph():
+    start_graph_build(asyncio.get_running_loop())
+    station_store.start_refresh()
+
+@app.on_event("shutdown")
+async def close_upstream_client():
+    await providers.provider.aclose()
+    station_store.stop_refresh()
+
 @app.get("/")
 async def root():
     return {"message": "API is running!"}
 
 @app.get("/route")
-async def get_route(origin: str, destination: str):
+async def get_route(origin: str, destination: str, objective: str = "energy"):
+    if objective not in OBJECTIVES:
+        raise HTTPException(status_code=400, detail=f"objective must be one of {OBJECTIVES}")
+    key = (normalize_place(origin), normalize_place(destination), objective)
     try:
-        env = environment(origin, destination)
-        step_reward, charge_num, SOC, time = env.origine_map_reward()
-
-        # ✅ Dummy route (Replace with actual data)
-        route = [
-            {"lat": 40.468254, "lng": -86.980963},
-            {"lat": 40.465123, "lng": -86.975432},
-            {"lat": 40.462345, "lng": -86.970123},
-            {"lat": 40.458765, "lng": -86.965432},
-            {"lat": 40.455432, "lng": -86.960123},
-            {"lat": 40.452345, "lng": -86.955432},
-            {"lat": 40.449876, "lng": -86.952345},
-            {"lat": 40.445283, "lng": -86.948429}
-        ]
+        # an empty route means LocationIQ was unavailable: answer it, but do not keep it for the ttl
+        return await route_cache.get(key, lambda: compute_route(origin, destination, objective),
+                                     cacheable=lambda result: bool(result["route"]))
 
+    except Exception as e:
+        logger.error(f"Error processing route: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+async def compute_route(origin, destination, objective):
+    # ✅ Geocoding is cached; when the road graph covers both ends the route is answered from it alone
+    env = environment(origin, destination, build_map=False)
+    origin_position, destination_position = await env.geocode_async()
+    optimal = await asyncio.to_thread(graph_route, env, objective)
+    if optimal is not None:
         return {
-            "reward": step_reward,
-            "charge_num": charge_num,
-            "SOC": SOC,
-            "time": time,
-            "route": route
+            "reward": -optimal["energy"] / 100000,   # the penalty battery.use_segment gives for that energy
+            "charge_num": optimal["charge_num"],
+            "SOC": optimal["SOC"],
+            "time": optimal["time"],
+            "route": optimal["route"],
+            "optimal": optimal,
+            "source": "graph"
         }
 
+    # ✅ Otherwise directions and elevations are awaited, so other requests keep being served
+    await env.directions_map_async(origin_position, destination_position)
+    step_reward, charge_num, SOC, time = await env.origine_map_reward_async()
+
+    # ✅ Energy/time-optimal route over the road graph, with its own time/energy/SOC; every
+    # fetched route also extends the graph. Off the event loop, like the requests above
+    optimal = await asyncio.to_thread(optimal_route, env, objective)
+
+    # ✅ reward, charge_num, SOC, time and route all describe the LocationIQ route
+    steps = env.Google_step or []
+    route = [{"lat": step["start_location"]["lat"], "lng": step["start_location"]["lng"]} for step in steps]
+    if steps:
+        route.append({"lat": steps[-1]["end_location"]["lat"], "lng": steps[-1]["end_location"]["lng"]})
+
+    return {
+        "reward": step_reward,
+        "charge_num": charge_num,
+        "SOC": SOC,
+        "time": time,
+        "route": route,
+        "optimal": optimal,
+        "source": "directions"
+    }
+
+@app.get("/policy-route")
+async def get_policy_route(origin: str, destination: str,
+                           max_step: int = Query(200, ge=1, le=POLICY_MAX_STEP)):   # each step can call the directions API
+    if policy_checkpoint is None:
+        raise HTTPException(status_code=503, detail="No trained policy loaded")
+    try:
+        # ✅ Greedy rollout of the trained Qnetwork; its forward passes are shared with concurrent requests
+        batcher = await get_policy()
+        env = await environment.create(origin, destination)
+        return await policy_rollout(env, batcher, max_step=max_step)
+
     except Exception as e:
-        logger.error(f"Error processing route: {e}")
+        logger.error(f"Error processing policy route: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
@@ -1,3 +1,4 @@
+import math
 import numpy as np
 
 class lithium_ion_battery():
@@ -39,4 +40,64 @@ class lithium_ion_battery():
             self.need_charge = False
         else:
             self.capacity = wh + self.capacity
-            self.need_charge = False
\ No newline at end of file
+            self.need_charge = False
+
+    def use_segment(self, duration, power):
+        # closed-form equivalent of calling use(duration=1, power=power) once per
+        # second for int(duration) seconds and recharging to full whenever it asks.
+        # returns (charge_num, energy_consume, reward_penalty, charge_times)
+        # charge_times are the seconds (from segment start) at which SOC <= 0.2 was hit
+        seconds = int(duration)
+        drain = power / 3600       # Wh per second
+        energy_consume = 0
+        charge_times = []
+        last_capacity = self.capacity
+        t = 0
+        while t < seconds:
+            if self.need_charge or self.capacity / self.total_capacity <= 0.2:
+                # recharge second: use() does not drain and energy_consume keeps its last value
+                last_capacity = self.capacity
+                energy_consume += self.energy_consume
+                charge_times.append(t)
+                self.charge(self.total_capacity)
+                t += 1
+                full = self.capacity == self.total_capacity
+                k = self._seconds_above_threshold(self.capacity, drain)
+                if full and k is not None and t < seconds:
+                    # from full the battery repeats k drain seconds + 1 recharge second
+                    period = k + 1
+                    cycles = (seconds - t) // period
+                    if cycles > 0:
+                        charge_times.extend(t + i * period + k for i in range(cycles))
+                        energy_consume += cycles * period * drain
+                        self.energy_consume = drain
+                        last_capacity = self.capacity - k * drain
+                        t += cycles * period
+                continue
+            k = self._seconds_above_threshold(self.capacity, drain)
+            m = seconds - t if k is None else min(k, seconds - t)
+            if m > 0:
+                last_capacity = self.capacity - (m - 1) * drain
+                self.capacity -= m * drain
+                self.energy_consume = drain
+                energy_consume += m * drain
+                t += m
+        if seconds > 0:
+            self.SOC = last_capacity / self.total_capacity
+            if self.SOC > 0.9:
+                self.SOC = 0.9
+            self.cell_voltage = self.SOC * 100 * self.grade + self.cutoff_voltage
+        return len(charge_times), energy_consume, energy_consume / 100000, charge_times
+
+    def _seconds_above_threshold(self, capacity, drain):
+        # number of 1 s drains before use() sees SOC <= 0.2, None if it never does
+        if capacity / self.total_capacity <= 0.2:
+            return 0
+        if drain <= 0:
+            return None
+        k = max(math.ceil((capacity - 0.2 * self.total_capacity) / drain), 0)
+        while k > 0 and (capacity - (k - 1) * drain) / self.total_capacity <= 0.2:
+            k -= 1
+        while (capacity - k * drain) / self.total_capacity > 0.2:
+            k += 1
+        return k
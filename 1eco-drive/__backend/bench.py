@@ -0,0 +1,471 @@
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+from datetime import datetime, timezone
+
+import numpy as np
+
+import providers
+
+# Microbenchmarks of the simulation and training hot paths.
+#
+#   python bench.py                         every benchmark, JSON on stdout
+#   python bench.py --output base.json      save the results
+#   python bench.py --compare base.json     exit 1 if anything got slower than --tolerance
+#   python bench.py --only env.step,replay  benchmarks whose name starts with one of these
+#   python bench.py --only startup          import time of the API server against STARTUP_BUDGET_S
+#   python bench.py --only startup --startup-budget 1.5
+#                                           a tighter budget, taken from a baseline on this machine
+#
+# Runs offline: every upstream call goes through providers in replay mode. A
+# fixture recorded in --fixtures (EVDRIVE_PROVIDER=record) is used when there is
+# one, every other directions/elevation request is answered by a deterministic
+# synthetic response, so the numbers do not depend on the network or on the
+# state of the local caches. The caches of Environment.py are opened in a
+# temporary directory; each benchmark measures the warm path training repeats.
+
+ORIGIN = (40.468254, -86.980963)   # main.py's route
+ROUTES = {                         # name -> destination, ~4 km, ~45 km and ~190 km from ORIGIN
+    "short": (40.445283, -86.948429),
+    "medium": (40.193, -86.617),
+    "long": (41.8781, -87.6298),
+}
+STEP_KM = 0.5                      # length of one synthetic directions step
+STARTUP_BUDGET_S = 3.0             # default --startup-budget: ~0.7 s measured, ~1.9 s on the slowest machine seen
+BENCHMARKS = []                    # (name, params, setup) in run order
+
+
+def benchmark(name, **params):
+    # setup(**params) prepares everything and returns run(n), which does n operations
+    def register(setup):
+        BENCHMARKS.append((name, params, setup))
+        return setup
+    return register
+
+
+# ---------------------------------------------------------------- fixtures
+
+def synthetic_elevation(lat, lng):   # smooth terrain, m
+    return 200 + 40 * math.sin(lat * 50) + 30 * math.cos(lng * 70)
+
+
+def synthetic_directions(origin, destination):   # LocationIQ directions JSON, origin/destination (lat, lng)
+    from haversine import haversine
+    km = haversine(origin, destination)
+    n = max(1, int(round(km / STEP_KM)))
+    points = []
+    for i in range(n + 1):
+        f = i / n
+        wiggle = 0.002 * math.sin(i * 0.7) if 0 < i < n else 0.0   # roads are not straight
+        points.append((origin[0] + f * (destination[0] - origin[0]) + wiggle,
+                       origin[1] + f * (destination[1] - origin[1]) - wiggle))
+    steps = []
+    for i in range(n):
+        meters = haversine(points[i], points[i + 1]) * 1000
+        speed = 14 + 8 * math.sin(i * 0.3)   # m/s
+        steps.append({"maneuver": {"location": [points[i][1], points[i][0]]},
+                      "next": {"maneuver": {"location": [points[i + 1][1], points[i + 1][0]]}},
+                      "distance": meters, "duration": meters / speed})
+    return {"code": "Ok", "routes": [{"legs": [{"steps": steps}]}]}
+
+
+class SyntheticFixtureStore(providers.FixtureStore):
+    # recorded fixtures first, then a synthetic answer for directions and elevation
+    # requests; nothing synthetic is written to the directory
+    def load(self, method, url, payload=None):
+        fixture = super().load(method, url, payload)
+        if fixture is not None:
+            return fixture
+        parts = urllib.parse.urlsplit(url)
+        if "/directions/" in parts.path:
+            ends = parts.path.rsplit("/", 1)[-1].split(";")
+            (lng0, lat0), (lng1, lat1) = (map(float, end.split(",")) for end in ends)
+            body = synthetic_directions((lat0, lng0), (lat1, lng1))
+        elif "elevation" in parts.netloc and payload is not None:
+            body = {"results": [dict(p, elevation=synthetic_elevation(p["latitude"], p["longitude"]))
+                                for p in payload["locations"]]}
+        else:
+            return {"status": 404, "body": None, "text": "no fixture"}
+        return {"status": 200, "body": body, "text": None}
+
+
+def make_env(route):
+    from Environment import environment
+    destination = ROUTES[route]
+    return environment("%s,%s" % ORIGIN, "%s,%s" % destination)
+
+
+@contextlib.contextmanager
+def quiet():   # Environment prints a DEBUG line per request
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+# ---------------------------------------------------------------- benchmarks
+
+@benchmark("env.step", route="short", actions=200)
+def bench_env_step(route, actions):
+    env = make_env(route)
+    env.length = 1   # main.py's 1000 m stride
+    sequence = np.random.default_rng(0).integers(0, 4, actions)
+
+    def run(n):
+        for i in range(n):
+            if i % actions == 0:
+                env.current_position = env.start_position
+                env.battery_charge()
+            env.step(int(sequence[i % actions]))
+    with quiet():
+        run(actions)   # every transition of the sequence is cached from here on
+    return run
+
+
+def bench_origine_map_reward(route):
+    env = make_env(route)
+
+    def run(n):
+        for _ in range(n):
+            env.origine_map_reward()
+    run.steps = len(env.Google_step or ())
+    return run
+
+
+for _route in ROUTES:
+    benchmark("env.origine_map_reward", route=_route)(bench_origine_map_reward)
+
+
+@benchmark("battery.use", seconds=3600, power=15000.0)
+def bench_battery_use(seconds, power):   # one op: the per-second drain loop over a one hour segment
+    from battery import lithium_ion_battery
+
+    def run(n):
+        for _ in range(n):
+            battery = lithium_ion_battery(50000)
+            for _ in range(seconds):
+                battery.use(duration=1, power=power)
+    return run
+
+
+@benchmark("battery.use_segment", seconds=3600, power=15000.0)
+def bench_battery_use_segment(seconds, power):   # the closed form of the same hour
+    from battery import lithium_ion_battery
+
+    def run(n):
+        for _ in range(n):
+            lithium_ion_battery(50000).use_segment(duration=seconds, power=power)
+    return run
+
+
+@benchmark("need_energy.energy")
+def bench_energy():
+    from motor import need_energy
+    model = need_energy()
+
+    def run(n):
+        for i in range(n):
+            model.energy(i % 10, 20.0)
+    return run
+
+
+@benchmark("need_energy.energy_array", segments=1000)
+def bench_energy_array(segments):
+    from motor import need_energy
+    model = need_energy()
+    rng = np.random.default_rng(0)
+    angle, speed = rng.uniform(0, 10, segments), rng.uniform(5, 35, segments)
+
+    def run(n):
+        for _ in range(n):
+            model.energy_array(angle, speed)
+    return run
+
+
+def full_buffer(cls, size):   # a replay buffer filled to capacity with random transitions
+    from replay_buffer import transition_dtype
+    buffer = cls(size=size)
+    rng = np.random.default_rng(0)
+    records = np.empty(size, dtype=transition_dtype())
+    records['state'] = rng.uniform(-90, 90, (size, 2))
+    records['action'] = rng.integers(0, 4, size)
+    records['reward'] = rng.uniform(-1, 1, size)
+    records['next_state'] = rng.uniform(-90, 90, (size, 2))
+    records['done'] = rng.random(size) < 0.01
+    buffer.extend(records)
+    return buffer
+
+
+@benchmark("replay.append", size=50000)
+def bench_replay_append(size):
+    from replay_buffer import experience_replay_buffer
+    buffer = full_buffer(experience_replay_buffer, size)
+    s, s1 = np.array([40.4, -86.9], dtype=np.float32), np.array([40.5, -86.9], dtype=np.float32)
+
+    def run(n):
+        for i in range(n):
+            buffer.append(s, i % 4, -0.1, s1, False)
+    return run
+
+
+@benchmark("replay.batch", size=50000, batch=32)
+def bench_replay_batch(size, batch):
+    from replay_buffer import experience_replay_buffer
+    buffer = full_buffer(experience_replay_buffer, size)
+
+    def run(n):
+        for _ in range(n):
+            buffer.batch(batch)
+    return run
+
+
+@benchmark("replay.prioritized_sample", size=50000, batch=32)
+def bench_prioritized_sample(size, batch):   # sample + priority update, as train_from does
+    from replay_buffer import prioritized_replay_buffer
+    buffer = full_buffer(prioritized_replay_buffer, size)
+    td_error = np.random.default_rng(0).normal(size=batch)
+
+    def run(n):
+        for _ in range(n):
+            _, idx, _ = buffer.sample(batch)
+            buffer.update_priorities(idx, td_error)
+    return run
+
+
+_graph = {}
+
+
+def dqn_graph():   # main.py's networks and trainer in a fresh graph, one session for every benchmark
+    if not _graph:
+        import tensorflow as tf
+        from DoubleDQN import Qnetwork, DoubleDQN
+        tf.compat.v1.reset_default_graph()
+        with tf.compat.v1.variable_scope('Qnet'):
+            Qnet = Qnetwork(s_size=2, a_size=4)
+        with tf.compat.v1.variable_scope('Targetnet'):
+            Targetnet = Qnetwork(s_size=2, a_size=4)
+        trainer = DoubleDQN(Qnet, Targetnet, gamma=0.9, tau=1.0)
+        sess = tf.compat.v1.Session()
+        sess.run(tf.compat.v1.global_variables_initializer())
+        trainer.sync_target(sess)
+        sess.graph.finalize()
+        _graph.update(tf=tf, Qnet=Qnet, trainer=trainer, sess=sess)
+    return _graph
+
+
+@benchmark("dqn.train_step", size=50000, batch=32)
+def bench_train_step(size, batch):   # trainer.train_from on a full buffer
+    from replay_buffer import experience_replay_buffer
+    g = dqn_graph()
+    buffer = full_buffer(experience_replay_buffer, size)
+
+    def run(n):
+        for _ in range(n):
+            g["trainer"].train_from(g["sess"], buffer, batch)
+    return run
+
+
+@benchmark("dqn.iteration", route="short", size=50000, batch=32)
+def bench_iteration(route, size, batch):
+    # one inner step of main.py: act, env.step, append, train (target sync every 5 updates)
+    from replay_buffer import experience_replay_buffer
+    g = dqn_graph()
+    sess, Qnet, trainer = g["sess"], g["Qnet"], g["trainer"]
+    buffer = full_buffer(experience_replay_buffer, size)
+    env = make_env(route)
+    env.length = 1
+    rng = np.random.default_rng(0)
+    state = {"s": env.start_position, "updates": 0}
+
+    def run(n):
+        for i in range(n):
+            s = state["s"]
+            action = sess.run(Qnet.predict, feed_dict={Qnet.input: [s]})[0]
+            if rng.random() < 0.5:
+                action = rng.integers(0, 4)
+            s1, r, d, charge_num, SOC = env.step(int(action))
+            buffer.append(s, action, r, s1, d)
+            trainer.train_from(sess, buffer, batch)
+            state["updates"] += 1
+            if state["updates"] % 5 == 0:
+                trainer.sync_target(sess)
+            state["s"] = env.start_position if d else s1
+    with quiet():
+        run(200)
+    return run
+
+
+@benchmark("startup.import_app")
+def bench_import_app():
+    # what a new API replica pays before its startup hooks run; every op is a new interpreter.
+    # Fails over the budget or when TensorFlow gets imported; --compare also catches smaller growth
+    backend = os.path.dirname(os.path.abspath(__file__))
+    code = "import sys, app; print('tensorflow' in sys.modules)"
+    loaded = []
+
+    def run(n):
+        for _ in range(n):
+            out = subprocess.run([sys.executable, "-c", code], cwd=backend, capture_output=True, text=True, check=True)
+            loaded.append(out.stdout.split()[-1] == "True")
+
+    def check(median):
+        failures = ["over the %.2f s budget" % STARTUP_BUDGET_S] if median > STARTUP_BUDGET_S else []
+        return failures + (["imports tensorflow"] if any(loaded) else [])
+    run.check = check
+    return run
+
+
+# ---------------------------------------------------------------- harness
+
+def measure(run, repeat, min_time):
+    # timeit-style: grow the number of ops per sample until a sample takes
+    # min_time, then take `repeat` samples; returns (ops per sample, seconds per op)
+    run(1)   # first-call costs (lazy imports, TF graph setup) are not part of the numbers
+    n = 1
+    while True:
+        start = time.perf_counter()
+        run(n)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        n = max(n + 1, int(n * min(10, 1.5 * min_time / max(elapsed, 1e-9))))
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(n)
+        samples.append((time.perf_counter() - start) / n)
+    return n, samples
+
+
+def run_benchmarks(only=None, repeat=5, min_time=0.2):
+    results = []
+    for name, params, setup in BENCHMARKS:
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        result = {"name": name, "params": params}
+        try:
+            with quiet():
+                run = setup(**params)
+                n, samples = measure(run, repeat, min_time)
+        except ImportError as e:   # e.g. no tensorflow here
+            result["skipped"] = str(e)
+        else:
+            median = statistics.median(samples)
+            result.update(ops=n, repeat=repeat, median_s=median, mean_s=statistics.mean(samples),
+                          min_s=min(samples), stdev_s=statistics.stdev(samples) if repeat > 1 else 0.0,
+                          ops_per_s=1 / median if median > 0 else None)
+            if hasattr(run, "steps"):
+                result["params"] = dict(params, steps=run.steps)
+            if hasattr(run, "check"):   # e.g. a time budget
+                result["failures"] = run.check(median)
+        results.append(result)
+        print(summary(result), file=sys.stderr)
+    return results
+
+
+def label(result):
+    return result["name"] + "".join("[%s=%s]" % item for item in result["params"].items())
+
+
+def summary(result):
+    label_ = label(result)
+    if "skipped" in result:
+        return "%-60s skipped: %s" % (label_, result["skipped"])
+    return "%-60s %12.3f us/op  (+-%.1f%%, %d x %d ops)%s" % (
+        label_, result["median_s"] * 1e6, 100 * result["stdev_s"] / result["median_s"], result["repeat"], result["ops"],
+        "".join("  FAILED: " + failure for failure in result.get("failures", ())))
+
+
+def environment_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    versions = {"python": platform.python_version(), "numpy": np.__version__}
+    if "tensorflow" in sys.modules:
+        versions["tensorflow"] = sys.modules["tensorflow"].__version__
+    return {"time": datetime.now(timezone.utc).isoformat(timespec="seconds"), "commit": commit,
+            "platform": platform.platform(), "machine": platform.machine(), "versions": versions}
+
+
+def key(result):
+    return result["name"], json.dumps(result["params"], sort_keys=True)
+
+
+def compare(results, baseline, tolerance):   # [(result, baseline result, ratio)] slower than tolerance
+    base = {key(r): r for r in baseline["results"] if "median_s" in r}
+    slower = []
+    for result in results:
+        old = base.get(key(result))
+        if old is None or "median_s" not in result:
+            continue
+        ratio = result["median_s"] / old["median_s"]
+        result["baseline_median_s"] = old["median_s"]
+        result["ratio"] = ratio
+        if ratio > 1 + tolerance:
+            slower.append((result, old, ratio))
+    return slower
+
+
+def main(argv=None):
+    global STARTUP_BUDGET_S
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the simulation and training hot paths")
+    parser.add_argument("--only", help="comma separated benchmark name prefixes")
+    parser.add_argument("--repeat", type=int, default=5, help="samples per benchmark")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per sample")
+    parser.add_argument("--fixtures", default=os.environ.get("EVDRIVE_FIXTURES", "fixtures"),
+                        help="recorded fixtures to replay before falling back to synthetic ones")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--compare", help="baseline JSON from an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed slowdown against --compare")
+    parser.add_argument("--startup-budget", type=float, default=STARTUP_BUDGET_S,
+                        help="seconds startup.import_app may take")
+    parser.add_argument("--list", action="store_true", help="list the benchmarks and exit")
+    args = parser.parse_args(argv)
+    STARTUP_BUDGET_S = args.startup_budget
+    if args.list:
+        for name, params, _ in BENCHMARKS:
+            print(name, json.dumps(params))
+        return 0
+
+    fixtures = os.path.abspath(args.fixtures)
+    providers.provider = providers.Provider("replay", SyntheticFixtureStore(fixtures))
+    only = args.only.split(",") if args.only else None
+    with tempfile.TemporaryDirectory() as workdir:   # Environment.py opens its SQLite caches in the cwd
+        cwd = os.getcwd()
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        os.chdir(workdir)
+        try:
+            results = run_benchmarks(only, args.repeat, args.min_time)
+        finally:
+            os.chdir(cwd)
+
+    report = {"environment": environment_info(), "fixtures": fixtures, "results": results}
+    status = 1 if any(result.get("failures") for result in results) else 0
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+        for result, old, ratio in slower:
+            print("SLOWER %s: %.3f us/op -> %.3f us/op (x%.2f)" % (
+                label(result), old["median_s"] * 1e6, result["median_s"] * 1e6, ratio), file=sys.stderr)
+        report["regressions"] = [result["name"] for result, _, _ in slower]
+        status = 1 if slower else status
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
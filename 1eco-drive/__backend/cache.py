@@ -0,0 +1,435 @@
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import weakref
+from collections import OrderedDict
+
+_LATLNG = re.compile(r"^\s*\(?\s*([+-]?\d+(?:\.\d+)?)\s*,\s*([+-]?\d+(?:\.\d+)?)\s*\)?\s*$")
+
+
+# SQLite connections must not be used across fork (actor_learner forks the
+# trainer). A forked child drops the connections it inherited and opens its own;
+# the inherited ones are kept referenced so the child never closes them either.
+_sqlite_owners = weakref.WeakSet()
+_inherited = []
+
+
+def _after_fork_in_child():
+    for owner in list(_sqlite_owners):
+        if owner._conn is not None:
+            _inherited.append(owner._conn)
+            owner._conn = None
+        owner._lock = threading.Lock()   # another thread may have held it at fork
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _open_db(path, schema):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute(schema)
+    conn.commit()
+    return conn
+
+
+class LRUCache:
+    # in-process least-recently-used cache with hit/miss counters
+    # ttl in seconds, None keeps entries until they are evicted
+    def __init__(self, maxsize=4096, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()   # key -> (value, expire time)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                value, expires = self._data[key]
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key not in self._data:
+                return False
+            expires = self._data[key][1]
+            return expires is None or expires > time.monotonic()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def parse_latlng(text):
+    # "lat,lng" (optionally in parentheses) -> (lat, lng), None for anything else
+    match = _LATLNG.match(str(text))
+    if match is None:
+        return None
+    lat, lng = float(match.group(1)), float(match.group(2))
+    if -90 <= lat <= 90 and -180 <= lng <= 180:
+        return lat, lng
+    return None
+
+
+def normalize_address(address):
+    # case, unicode form, punctuation and whitespace do not change what an address means
+    text = unicodedata.normalize("NFKC", str(address)).casefold()
+    text = "".join(" " if unicodedata.category(ch)[0] in "PSZ" else ch for ch in text)
+    return " ".join(text.split())
+
+
+def normalize_place(text, precision=5):
+    # origin/destination as a cache key: rounded coordinates or a normalized address
+    position = parse_latlng(text)
+    if position is not None:
+        return "%.*f,%.*f" % (precision, position[0], precision, position[1])
+    return normalize_address(text)
+
+
+class ElevationCache:
+    # elevation never changes, so points are cached forever.
+    # lat/lng are quantized to `precision` decimals (5 ~ 1 m) and kept in an
+    # LRU memory tier in front of a SQLite file that survives restarts.
+    def __init__(self, path="elevation_cache.db", precision=5, memory_size=65536):
+        self.path = path
+        self.precision = precision
+        self.memory = LRUCache(memory_size)
+        self.hits = 0     # answered from memory or disk
+        self.misses = 0   # had to go to the elevation service
+        self._conn = None
+        self._lock = threading.Lock()
+        _sqlite_owners.add(self)
+
+    def key(self, lat, lng):
+        scale = 10 ** self.precision
+        return int(round(float(lat) * scale)), int(round(float(lng) * scale))
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = _open_db(
+                self.path,
+                "CREATE TABLE IF NOT EXISTS elevation ("
+                "precision INTEGER, lat INTEGER, lng INTEGER, elevation REAL, "
+                "PRIMARY KEY (precision, lat, lng))",
+            )
+        return self._conn
+
+    def get(self, lat, lng):
+        key = self.key(lat, lng)
+        elevation = self.memory.get(key)
+        if elevation is None:
+            with self._lock:
+                row = self._connect().execute(
+                    "SELECT elevation FROM elevation WHERE precision=? AND lat=? AND lng=?",
+                    (self.precision, key[0], key[1]),
+                ).fetchone()
+            if row is not None:
+                elevation = row[0]
+                self.memory.put(key, elevation)
+        if elevation is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return elevation
+
+    def put(self, lat, lng, elevation):
+        self.put_many([(lat, lng, elevation)])
+
+    def put_many(self, points):
+        # points: iterable of (lat, lng, elevation)
+        rows = []
+        for lat, lng, elevation in points:
+            key = self.key(lat, lng)
+            self.memory.put(key, elevation)
+            rows.append((self.precision, key[0], key[1], float(elevation)))
+        if not rows:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("INSERT OR REPLACE INTO elevation VALUES (?, ?, ?, ?)", rows)
+            conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_hits": self.memory.hits,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class DirectionsCache:
+    # parsed directions (step list and bounds) keyed on the quantized
+    # (origin, destination) pair. Entries expire after `ttl` seconds and at
+    # most `maxsize` routes are kept; with a `path` they are also stored in
+    # SQLite so later runs start warm. The table is pruned only once it holds
+    # more than maxsize rows, down to 90% of it, not on every put.
+    def __init__(self, path=None, precision=5, maxsize=20000, ttl=30 * 24 * 3600):
+        self.path = path
+        self.precision = precision
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.memory = LRUCache(maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._rows = 0   # rows in the table, an upper bound: a replaced key is counted again
+        self._lock = threading.Lock()
+        _sqlite_owners.add(self)
+
+    def key(self, origin, destination):
+        # origin, destination: (lat, lng)
+        scale = 10 ** self.precision
+        return "%d,%d;%d,%d" % tuple(int(round(float(v) * scale)) for v in (*origin, *destination))
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = _open_db(
+                self.path,
+                "CREATE TABLE IF NOT EXISTS directions ("
+                "key TEXT PRIMARY KEY, created REAL, steps TEXT, bound TEXT)",
+            )
+            self._rows = self._conn.execute("SELECT COUNT(*) FROM directions").fetchone()[0]
+        return self._conn
+
+    def get(self, origin, destination):  # 2 output: steps, bound (None, None on a miss)
+        key = self.key(origin, destination)
+        entry = self.memory.get(key)
+        if entry is None and self.path is not None:
+            with self._lock:
+                row = self._connect().execute(
+                    "SELECT created, steps, bound FROM directions WHERE key=?", (key,)
+                ).fetchone()
+            if row is not None:
+                age = time.time() - row[0]
+                if self.ttl is None or age < self.ttl:
+                    entry = (json.loads(row[1]), json.loads(row[2]))
+                    remaining = None if self.ttl is None else self.ttl - age
+                    self.memory.put(key, entry, ttl=remaining)
+        if entry is None:
+            self.misses += 1
+            return None, None
+        self.hits += 1
+        return entry
+
+    def put(self, origin, destination, steps, bound):
+        key = self.key(origin, destination)
+        self.memory.put(key, (steps, bound))
+        if self.path is None:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO directions VALUES (?, ?, ?, ?)",
+                (key, time.time(), json.dumps(steps), json.dumps(bound)),
+            )
+            self._rows += 1
+            if self._rows > self.maxsize:
+                self.prune(conn)
+            conn.commit()
+
+    def prune(self, conn):   # expired rows, then the oldest beyond 90% of maxsize; call with _lock held
+        if self.ttl is not None:
+            conn.execute("DELETE FROM directions WHERE created < ?", (time.time() - self.ttl,))
+        conn.execute(
+            "DELETE FROM directions WHERE key NOT IN "
+            "(SELECT key FROM directions ORDER BY created DESC LIMIT ?)",
+            (self.maxsize - self.maxsize // 10,),
+        )
+        self._rows = conn.execute("SELECT COUNT(*) FROM directions").fetchone()[0]
+
+    def routes(self):  # step list of every unexpired cached route, e.g. to build a road graph
+        if self.path is None:
+            with self.memory._lock:
+                entries = [value for value, expires in self.memory._data.values()
+                           if expires is None or expires > time.monotonic()]
+            return [steps for steps, bound in entries]
+        oldest = 0 if self.ttl is None else time.time() - self.ttl
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT steps FROM directions WHERE created >= ?", (oldest,)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_hits": self.memory.hits,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class GeocodingCache:
+    # address -> (lat, lng). "lat,lng" inputs are answered without a lookup;
+    # other addresses are cached under normalize_address(address), in memory
+    # and, with a `path`, in SQLite. Only successful geocodes are stored.
+    def __init__(self, path=None, maxsize=50000, ttl=90 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self.memory = LRUCache(maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+        self.literals = 0   # inputs that already were coordinates
+        self._conn = None
+        self._lock = threading.Lock()
+        _sqlite_owners.add(self)
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = _open_db(
+                self.path,
+                "CREATE TABLE IF NOT EXISTS geocoding ("
+                "key TEXT PRIMARY KEY, created REAL, lat REAL, lng REAL)",
+            )
+        return self._conn
+
+    def get(self, address):  # (lat, lng) or None on a miss
+        position = parse_latlng(address)
+        if position is not None:
+            self.literals += 1
+            return position
+        key = normalize_address(address)
+        position = self.memory.get(key)
+        if position is None and self.path is not None:
+            with self._lock:
+                row = self._connect().execute(
+                    "SELECT created, lat, lng FROM geocoding WHERE key=?", (key,)
+                ).fetchone()
+            if row is not None:
+                age = time.time() - row[0]
+                if self.ttl is None or age < self.ttl:
+                    position = (row[1], row[2])
+                    self.memory.put(key, position, ttl=None if self.ttl is None else self.ttl - age)
+        if position is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return position
+
+    def put(self, address, lat, lng):
+        if parse_latlng(address) is not None:
+            return
+        key = normalize_address(address)
+        self.memory.put(key, (float(lat), float(lng)))
+        if self.path is None:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO geocoding VALUES (?, ?, ?, ?)",
+                         (key, time.time(), float(lat), float(lng)))
+            conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "literals": self.literals,
+            "memory_hits": self.memory.hits,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_MISSING = object()
+
+
+class ResponseCache:
+    # results of an async computation per key. Finished results are kept for
+    # `ttl` seconds (at most `maxsize` of them); a call for a key that is being
+    # computed right now waits for that computation instead of starting another
+    # one (single flight). Exceptions are not cached, nor are results that
+    # get(..., cacheable=...) rejects (e.g. a degraded answer). Use from one event loop.
+    def __init__(self, maxsize=1024, ttl=300):
+        self.memory = LRUCache(maxsize, ttl=ttl)
+        self.inflight = {}   # key -> asyncio.Task
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0   # calls that joined a computation already running
+
+    async def get(self, key, compute, cacheable=None):
+        # compute: no-argument coroutine function producing the value
+        # cacheable: optional predicate on the value, False keeps it out of the cache
+        value = self.memory.get(key, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+        task = self.inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(compute())
+            self.inflight[key] = task
+            task.add_done_callback(lambda done: self.finished(key, done, cacheable))
+        else:
+            self.coalesced += 1
+        # a caller that goes away must not cancel the computation the others wait on
+        return await asyncio.shield(task)
+
+    def finished(self, key, task, cacheable=None):
+        self.inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        if cacheable is None or cacheable(task.result()):
+            self.memory.put(key, task.result())
+
+    def clear(self):
+        self.memory.clear()
+
+    def stats(self):
+        total = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "inflight": len(self.inflight),
+            "size": len(self.memory),
+            "hit_rate": (self.hits + self.coalesced) / total if total else 0.0,
+        }
@@ -1,5 +1,11 @@
 from Environment import environment
-from DoubleDQN import Qnetwork
+from transition_table import transition_table
+from replay_buffer import experience_replay_buffer, prioritized_replay_buffer, buffer_store
+from vector_env import vector_environment
+from actor_learner import actor_pool, run_learner
+import profiler
+import os
+from DoubleDQN import Qnetwork, DoubleDQN
 import numpy as np
 import tensorflow as tf
 tf.compat.v1.disable_eager_execution()
@@ -7,62 +13,10 @@ import pandas as pd
 import time as tm
 from haversine import haversine
 #import random
-from random import sample
 import math
 # action is in the set of (0,1,2,3) = (north, east, south, west)
 # s1, r, d = env.step(2)   # s1: next state = (lat,lng)  // r: reward for taking step  // d: End, True or False
 #  initialize environment  env = environment('Purdue University West Lafayette', '40.3025301,-86.886558')
-class experience_replay_buffer():
-    def __init__(self, size = 50000):
-        self.buffer = []
-        self.buffersave = []
-        self.buffersize = size
-        self.currents1 = []
-        self.currents2 = []
-        self.actions = []
-        self.rewards = []
-        self.nexts1 = []
-        self.nexts2 = []
-        self.ds = []
-    def append(self, exp):
-        if len(self.buffer) + len(exp) >= self.buffersize:
-            self.buffer[0:len(self.buffer) + len(exp) - self.buffersize] = []
-        if len(self.buffersave) + len(exp) >= self.buffersize:
-            self.buffersave[0:len(self.buffersave) + len(exp) - self.buffersize] = []
-        if len(self.currents1) + len(exp) >= self.buffersize:
-            self.currents1[0:len(self.currents1) + len(exp) - self.buffersize] = []
-        if len(self.currents2) + len(exp) >= self.buffersize:
-            self.currents2[0:len(self.currents2) + len(exp) - self.buffersize] = []
-        if len(self.actions) + len(exp) >= self.buffersize:
-            self.actions[0:len(self.actions) + len(exp) - self.buffersize] = []
-        if len(self.rewards) + len(exp) >= self.buffersize:
-            self.rewards[0:len(self.rewards) + len(exp) - self.buffersize] = []
-        if len(self.nexts1) + len(exp) >= self.buffersize:
-            self.nexts1[0:len(self.nexts1) + len(exp) - self.buffersize] = []
-        if len(self.nexts2) + len(exp) >= self.buffersize:
-            self.nexts2[0:len(self.nexts2) + len(exp) - self.buffersize] = []
-        if len(self.ds) + len(exp) >= self.buffersize:
-            self.ds[0:len(self.ds) + len(exp) - self.buffersize] = []
-        self.buffer.extend(exp)
-        self.buffersave.append(exp)
-        self.currents1.append(exp[0][0][0])
-        self.currents2.append(exp[0][0][1])
-        self.actions.append(exp[0][1])
-        self.rewards.append(exp[0][2])
-        self.nexts1.append(exp[0][3][0])
-        self.nexts2.append(exp[0][3][1])
-        self.ds.append(exp[0][4])
-    def batch(self, num):
-        return np.reshape(np.array(sample(self.buffer, num)),[num, 5])
-
-def update_net(trainable_var, sess):
-    num = len(trainable_var)
-    container = []
-    for id,var in enumerate(trainable_var[0:int(num/2)]):
-        container.append(trainable_var[id+int(num/2)].assign(var))
-    for contain in container:
-        sess.run(contain)
-    
 print("------------for tensorflow --------------")
 #tf.reset_default_graph()
 tf.compat.v1.reset_default_graph()
@@ -72,6 +26,7 @@ with tf.compat.v1.variable_scope('Qnet'):
 #with tf.variable_scope('Targetnet'):
 with tf.compat.v1.variable_scope('Targetnet'):
     Targetnet = Qnetwork(s_size=2, a_size=4)
+trainer = DoubleDQN(Qnet, Targetnet, gamma=0.9, tau=1.0)   # fused training op; tau < 1 soft-updates Targetnet
 
 
 
@@ -82,6 +37,17 @@ env.battery_charge()
 step_length = 1000  # meter
 env.length = 1000 / step_length
 print("stride length: ", env.length)
+tabular = False   # step on the precomputed grid transitions instead of the live APIs
+table_path = "./ev/transition_table.npz"
+if tabular == True:
+    if os.path.exists(table_path):
+        table = transition_table.load(table_path)
+    else:
+        table = transition_table.build(env)
+        os.makedirs(os.path.dirname(table_path), exist_ok=True)
+        table.save(table_path)
+    env.use_table(table)
+    print("transition table grid: ", table.shape)
 learning_rate = 0.0001
 #sleep = False
 
@@ -114,7 +80,8 @@ print("Pre train step: ", pre_train_step)
 s_list = list(s)
 print("start position: ", s_list)
 print("end position: ", env.end_position)
-replay_buffer = experience_replay_buffer()
+prioritized = False   # sample the replay buffer by TD error instead of uniformly
+replay_buffer = prioritized_replay_buffer() if prioritized else experience_replay_buffer()
 init = tf.compat.v1.global_variables_initializer()
 trainable_var = tf.compat.v1.trainable_variables()
 print("trainable_var", len(trainable_var))
@@ -126,9 +93,18 @@ path = "./ev/model"
 pre_train = pre_train_step  # don't update and train the model within these steps
 train_num = 300   # total episode num
 max_step = max_train_step
-updata_f = 5   # frequency of copy weights from Qnet to Targetnet
+updata_f = 5   # frequency of copy weights from Qnet to Targetnet (use 1 with a soft update)
 batch_num = 32
-gamma = 0.9 # discount factor
+num_envs = 1   # >1 steps N-1 copies of env alongside it and stores their transitions too
+vec_env = vector_environment(env, num_envs, max_step=max_step) if num_envs > 1 else None
+num_actors = 0   # >0 steps the route in this many actor processes and only trains here
+learner_updates = train_num * max_step   # learner updates when num_actors > 0
+broadcast_f = 50   # frequency of sending Qnet weights to the actors
+profile = False   # time each phase of every episode and add the seconds to result.csv (profiler.COLUMNS)
+prof = profiler.phase_profiler() if profile == True else profiler.disabled
+env.profiler = prof
+trainer.profiler = prof
+gamma = trainer.gamma # discount factor, built into the trainer graph
 high_prob = 1
 low_prob = 0.1
 slope = (high_prob - low_prob) / 20000
@@ -142,38 +118,13 @@ if load_model == True:
 ############### initialize constant
 tt = 0
 ############### load the replay buffer
+store = buffer_store("./ev/buffer")
 if load_model == True:
-    with open("./ev/buffercurrents1.txt", "r") as f:
-        buffercurrents1 = f.readlines()
-        buffercurrents1 = [x.strip() for x in buffercurrents1]
-    with open("./ev/buffercurrents2.txt", "r") as f:
-        buffercurrents2 = f.readlines()
-        buffercurrents2 = [x.strip() for x in buffercurrents2]
-    with open("./ev/bufferactions.txt", "r") as f:
-        bufferactions = f.readlines()
-        bufferactions = [x.strip() for x in bufferactions]
-    with open("./ev/buffernexts1.txt", "r") as f:
-        buffernexts1 = f.readlines()
-        buffernexts1 = [x.strip() for x in buffernexts1]
-    with open("./ev/buffernexts2.txt", "r") as f:
-        buffernexts2 = f.readlines()
-        buffernexts2 = [x.strip() for x in buffernexts2]
-    with open("./ev/bufferrewards.txt", "r") as f:
-        bufferrewards = f.readlines()
-        bufferrewards = [x.strip() for x in bufferrewards]
-    with open("./ev/bufferds.txt", "r") as f:
-        bufferds = f.readlines()
-        bufferds = [x.strip() for x in bufferds]
-    for current1, current2, action, reward, next1, next2, ds in zip(buffercurrents1, buffercurrents2, bufferactions, bufferrewards, buffernexts1, buffernexts2, bufferds):
-        if ds == 'True':
-            boo = True
-        if ds == 'False':
-            boo = False
-        replay_buffer.buffer.extend(np.reshape(np.array([[float(current1),float(current2)], int(action), float(reward), [float(next1),float(next2)], boo]),[1,5]))
-        
-        
+    store.load(replay_buffer)
+else:
+    store.reset()
 print("load buffer success............................")
-print(replay_buffer.buffer)
+print("buffer size: ", len(replay_buffer))
 print("------------Save training parameters--------------")
 parameter = [env.map_bound, map_height, map_wide, step_length, wide_grid_num, height_grid_num, total_point, max_train_step, pre_train_step, learning_rate, step_rewardG, chargenumG, SOCG, timeG]
 df_1 = pd.DataFrame([parameter])
@@ -181,6 +132,9 @@ df_1.to_csv("train_para.csv", header=["google map_boundary", "map_height(km)", "
 
 print("sleep 5 min")
 tm.sleep(10)
+if num_actors > 0:   # fork the actors before the session exists
+    actors = actor_pool(num_actors, (env.origin, env.destination, env.length, table_path if tabular == True else None), max_step)
+    actors.start()
 print("------------Start training --------------")
 with tf.compat.v1.Session() as sess:
     sess.run(init)
@@ -193,11 +147,24 @@ with tf.compat.v1.Session() as sess:
         print("Loading Model....")
         saver.restore(sess, pathload+"/model-"+str(modelnum)+".ckpt")
         print("Model restored.")
+    sess.graph.finalize()   # every op exists by now; the graph must not grow while training
+
+    if num_actors > 0:
+        losses = run_learner(sess, Qnet, trainer, actors, replay_buffer, learner_updates, batch_num,
+                             updata_f, broadcast_f, e=high_prob, low_prob=low_prob, slope=slope)
+        actors.close(replay_buffer)
+        store.save(replay_buffer)
+        save_path = saver.save(sess, path+"/model-learner.ckpt")
+        print("Learner updates: ", len(losses), " buffer size: ", len(replay_buffer))
+        train_num = 0   # the actors ran the episodes
 
     for episode in range(train_num):  # num of episode
+        prof.start_episode()
         s = env.start_position
         s_list = list(s)
         env.battery_charge()
+        if vec_env is not None:
+            vec_env.reset_twins()   # the N-1 copies start every episode from the origin too
         ss, nn = env.battery_condition()
         print("Current Episode: ", episode_num)
         #print("SOC, charge_number: ",ss,nn)
@@ -214,7 +181,6 @@ with tf.compat.v1.Session() as sess:
         overQ_num = 0 # OVER_QUERY_LIMIT
         unreach_step_history = []
         loss_history = []
-        overQ_num_roll = 0
         #print("----------------")
         #inputt = sess.run(Qnet.inputt, feed_dict={Qnet.input:[s_list]})[0]
         #print("inputt: ",inputt)
@@ -227,16 +193,21 @@ with tf.compat.v1.Session() as sess:
             Q_value = 0
             in_ep_loss = 0
             update_num = 0
-            if np.random.rand(1) < e or (total_step < pre_train and load_model == False):
-                action = np.random.randint(0,4)
-                test = 1 # try
-            else:
-                #inputt = sess.run(Qnet.inputt, feed_dict={Qnet.input:[s_list]})[0]
-                action = sess.run(Qnet.predict, feed_dict={Qnet.input:[s_list]})[0]
-                #action = float(actionn)
-                Q_value = sess.run(Qnet.action, feed_dict={Qnet.input:[s_list]}) # for data analysis
-                test = 2 # try
-                #print("inputt: ",inputt)
+            with prof.phase("action"):
+                if vec_env is not None:   # actions for all N environments from one batched forward pass
+                    vec_states, vec_actions, explored = vec_env.act(sess, Qnet, 1 if (total_step < pre_train and load_model == False) else e)
+                    action = int(vec_actions[0])
+                    test = 1 if explored[0] else 2
+                elif np.random.rand(1) < e or (total_step < pre_train and load_model == False):
+                    action = np.random.randint(0,4)
+                    test = 1 # try
+                else:
+                    #inputt = sess.run(Qnet.inputt, feed_dict={Qnet.input:[s_list]})[0]
+                    action, Q_value = sess.run([Qnet.predict, Qnet.action], feed_dict={Qnet.input:[s_list]}) # Q_value for data analysis
+                    action = action[0]
+                    #action = float(actionn)
+                    test = 2 # try
+                    #print("inputt: ",inputt)
             #print(action)
 	    # how to choose action 
             if test == 1:
@@ -245,7 +216,13 @@ with tf.compat.v1.Session() as sess:
             if test == 2:
                 network_a = network_a + 1
             # take the action and get s', r, status, chargenum, SOC
-            s1, r, d, charge_num, SOC = env.step(action)  
+            with prof.phase("env_step"):
+                if vec_env is not None:
+                    vec_results = vec_env.step(vec_actions)
+                    s1, r, d, charge_num, SOC = vec_results[0]
+                    vec_env.store(replay_buffer, vec_states, vec_actions, vec_results, first=1)
+                else:
+                    s1, r, d, charge_num, SOC = env.step(action)  
             s = list(s1)
             #print(SOC)
             
@@ -263,47 +240,25 @@ with tf.compat.v1.Session() as sess:
                 #replay_buffer.append((s_list, action, r, s, d))  # Using a tuple
 
                 #s_list_nested = [[s_list[0], s_list[1]]]  # or [[[s_list[0]], [[s_list[1]]]]] depending on expected structure
-                s_list_nested = [[s_list, action]]
-                replay_buffer.append((s_list_nested, action, r, s, d))
+                replay_buffer.append(s_list, action, r, s, d)
                 in_ep_step = in_ep_step + 1
                 total_step = total_step + 1
                 s_list = s
             if env.status_dir_check == 'OVER_QUERY_LIMIT':
                 overQ_num = overQ_num + 1
-                overQ_num_roll = overQ_num_roll + 1             
-            if (total_step > pre_train and env.status_dir_check != 'OVER_QUERY_LIMIT' and len(replay_buffer.buffer) > batch_num) or (load_model == True and len(replay_buffer.buffer) > batch_num):  # start updating model
+            if (total_step > pre_train and env.status_dir_check != 'OVER_QUERY_LIMIT' and len(replay_buffer) > batch_num) or (load_model == True and len(replay_buffer) > batch_num):  # start updating model
                 if e > low_prob:
                     e -= slope                     
-                ex_batch = replay_buffer.batch(batch_num)
-                #Qnet_action_Qvalue = sess.run(Qnet.action, feed_dict={Qnet.input:np.vstack(ex_batch[:,3])})
-                #print("$$$$$$$$$$$$$$$$")
-                #print(Qnet_action_Qvalue)
-                #print("$$$$$$$$$$$$$$$$")
-                Qnet_pre = sess.run(Qnet.predict, feed_dict={Qnet.input:np.vstack(ex_batch[:,3])})
-                #print(Qnet_pre)
-                Targetnet_action = sess.run(Targetnet.action, feed_dict={Targetnet.input:np.vstack(ex_batch[:,3])})
-                #print(Targetnet_action)
-                mul = 1 - ex_batch[:,4]   # 1 if d=False; 0 if d=True
-                #print(mul)
-                y = ex_batch[:,2] + mul * gamma * Targetnet_action[range(batch_num),Qnet_pre]  # target Q
-                #print(y)
-                #Q = sess.run(Targetnet.Q, feed_dict={Targetnet.input:np.vstack(ex_batch[:,3]), Targetnet.a:ex_batch[:,1]})
-                #print(Q)
-                #error = sess.run(Targetnet.error, feed_dict={Targetnet.input:np.vstack(ex_batch[:,3]),Targetnet.target_y:y, Targetnet.a:ex_batch[:,1]})
-                #print(error)
-                loss = sess.run(Qnet.loss, feed_dict={Qnet.input:np.vstack(ex_batch[:,0]),Qnet.target_y:y, Qnet.a:ex_batch[:,1]}) # We use Qnet loss to update Qnet
+                loss = trainer.train_from(sess, replay_buffer, batch_num)
                 in_ep_loss = in_ep_loss + loss
                 if total_step % 10 == 0:
                     loss_history.append(loss)
-                #print(loss)
-                # update model
-                _ = sess.run(Qnet.update, feed_dict={Qnet.input:np.vstack(ex_batch[:,0]),Qnet.target_y:y, Qnet.a:ex_batch[:,1]})   # input is s not s1
                 istrain = 1  # try
             	
 
             if total_step % updata_f == 0:    # copy weights from Qnet to Targetnet
                 #print("we copy weights from Qnet to Targetnet")
-                update_net(trainable_var, sess)
+                trainer.sync_target(sess)
                 isupdate = 1 # try
                 update_num = update_num + 1
             #testt.append([test, action, istrain, isupdate])  # try
@@ -329,14 +284,8 @@ with tf.compat.v1.Session() as sess:
                 #print("charging routine: ", battery[-1])
                 time = env.time
                 history = [episode+1, in_ep_step, time, episode_reward, real_reward, real_r_nofail, charge_num, SOC, env.unreach_position_num, d, random_a/(random_a+network_a), avg_loss, overQ_num, loss_history, step_buffer]
-                if episode == 0:                    
-                    df = pd.DataFrame([history])
-                    df.to_csv("./ev/result.csv", header=["episode", "step", "time", "reward", "reward_notrain", "reward_nofail", "charge_num", "SOC", "unreach_position", "Reach", "Random_a", "Avg_loss", "overQuery_num", "Loss history", "Step history"])
+                if episode == 0:
                     tt = tt + 1
-                elif episode > 0:
-                    with open('./ev/result.csv', 'a') as f:
-                        df = pd.DataFrame([history])
-                        df.to_csv(f, header=False)
                 print("Total time: ", time)
                 print("number of failed step: ", env.unreach_position_num)
                 
@@ -361,13 +310,6 @@ with tf.compat.v1.Session() as sess:
                 real_reward = episode_reward + 0.1 * (in_ep_step - env.unreach_position_num)  # We don't penalize transition for real_reward(compare with google route) and we don't count the goal 
                 real_r_nofail = real_reward + env.unreach_position_num
                 history = [episode+1, in_ep_step, time, episode_reward, real_reward, real_r_nofail, charge_num, SOC, env.unreach_position_num, d, random_a/(random_a+network_a), avg_loss, overQ_num, loss_history, step_buffer]
-                if episode == 0:
-                    df = pd.DataFrame([history])
-                    df.to_csv("./ev/result.csv", header=["episode", "step", "time", "reward", "reward_notrain", "reward_nofail", "charge_num", "SOC", "unreach_position", "Reach", "Random_a", "Avg_loss", "overQuery_num", "Loss history", "Step history"])
-                elif episode > 0:
-                    with open('./ev/result.csv', 'a') as f:
-                        df = pd.DataFrame([history])
-                        df.to_csv(f, header=False)
                 #env.current_position = env.start_position  # reset the start position to origine
                 #s = env.start_position  # reset the start position to origine
                 #s_list = list(s)
@@ -377,14 +319,12 @@ with tf.compat.v1.Session() as sess:
                 break
                 
             #total_step = total_step + 1
-            if overQ_num_roll > 50:
-                overQ_num_roll = 0
-                print("Sleeping within episode for 60 min")
-                tm.sleep(3600)
+            # rate limits are retried with backoff in providers, no need to sleep for an hour here
 
         if d == True and in_ep_step < 60 and episode > 10 and episode % 1 == 0 or (load_model == True and d == True):
             j = episode + 1
-            save_path = saver.save(sess, path+"/model-"+str(j)+".ckpt")
+            with prof.phase("checkpoint"):
+                save_path = saver.save(sess, path+"/model-"+str(j)+".ckpt")
             print("Saved model with step less than steps 60")
             
         print("Last position: ", env.current_position)
@@ -403,32 +343,23 @@ with tf.compat.v1.Session() as sess:
         reward_history.append(episode_reward)
         env.battery_charge()
         ###################### save the repaly buffer ############################
-        with open("./ev/buffercurrents1.txt", "w") as ff:    # save the replay buffer
-            for s in replay_buffer.currents1:
-                ff.write(str(s) + "\n")
-        with open("./ev/buffercurrents2.txt", "w") as mm:    # save the replay buffer
-            for s in replay_buffer.currents2:
-                mm.write(str(s) + "\n")
-        with open("./ev/bufferactions.txt", "w") as gg:    # save the replay buffer
-            for s in replay_buffer.actions:
-                gg.write(str(s) + "\n")
-        with open("./ev/bufferrewards.txt", "w") as hh:    # save the replay buffer
-            for s in replay_buffer.rewards:
-                hh.write(str(s) + "\n")
-        with open("./ev/buffernexts1.txt", "w") as ii:    # save the replay buffer
-            for s in replay_buffer.nexts1:
-                ii.write(str(s) + "\n")
-        with open("./ev/buffernexts2.txt", "w") as kk:    # save the replay buffer
-            for s in replay_buffer.nexts2:
-                kk.write(str(s) + "\n")
-        with open("./ev/bufferds.txt", "w") as jj:    # save the replay buffer
-            for s in replay_buffer.ds:
-                jj.write(str(s) + "\n")
+        with prof.phase("buffer_save"):
+            store.save(replay_buffer)   # only this episode's transitions are written
         ###################### save the repaly buffer ############################
-        if (total_step > 450 and total_step % 120 == 0) or sleep == True:
+        if tabular == False and sleep == True:   # manual cool-down; 429s are backed off in providers
             print("Sleeping now for 20 min")
-            tm.sleep(1230)
+            with prof.phase("sleep"):
+                tm.sleep(1230)
             #print("Sleeping now for 10 min")
+        # the episode record, written once the episode's saves and sleep are timed too
+        history = history + prof.finish_episode()
+        if episode == 0:
+            df = pd.DataFrame([history])
+            df.to_csv("./ev/result.csv", header=["episode", "step", "time", "reward", "reward_notrain", "reward_nofail", "charge_num", "SOC", "unreach_position", "Reach", "Random_a", "Avg_loss", "overQuery_num", "Loss history", "Step history"] + (list(profiler.COLUMNS) if prof.enabled else []))
+        elif episode > 0:
+            with open('./ev/result.csv', 'a') as f:
+                df = pd.DataFrame([history])
+                df.to_csv(f, header=False)
         #print("total step: ", total_step)  # try
         print("-------------------------------------------------------------------------------")
     #print(step_buffer[:,2])
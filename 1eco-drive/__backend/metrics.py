@@ -0,0 +1,176 @@
+import bisect
+import threading
+import time
+import urllib.parse
+
+# Minimal in-process metrics rendered in the Prometheus text format (no client
+# library needed). Counters and histograms are keyed by a tuple of label values;
+# collectors are functions called at scrape time, e.g. for cache statistics.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    text = ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+    return "{" + text + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        labels = tuple(str(label) for label in labels)   # 200 and "error" must sort together
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        with self._lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append("%s%s %s" % (self.name, _labels(self.labels, labels), value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}   # labels -> [bucket counts..., +Inf count, sum]
+        self.listeners = []   # listener(seconds, *labels) called on every observation
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *labels):
+        i = bisect.bisect_left(self.buckets, seconds)
+        labels = tuple(str(label) for label in labels)
+        with self._lock:
+            value = self.values.get(labels)
+            if value is None:
+                value = self.values[labels] = [0] * (len(self.buckets) + 2)
+            value[i] += 1
+            value[-1] += seconds
+        for listener in self.listeners:
+            listener(seconds, *labels)
+
+    def time(self, *labels):   # with histogram.time("x"): ...
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self._lock:
+            for labels, value in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), value[:-1]):
+                    cumulative += count
+                    lines.append("%s_bucket%s %d" % (self.name, _labels(self.labels, labels, [("le", bound)]), cumulative))
+                lines.append("%s_sum%s %s" % (self.name, _labels(self.labels, labels), value[-1]))
+                lines.append("%s_count%s %d" % (self.name, _labels(self.labels, labels), cumulative))
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []   # functions returning [(name, type, help, {labels tuple: value}, label names)]
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, function):
+        self.collectors.append(function)
+        return function
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        families = {}
+        for function in self.collectors:
+            for name, kind, help, names, values in function():
+                family = families.setdefault(name, (kind, help, names, {}))
+                family[3].update(values)
+        for name, (kind, help, names, values) in families.items():
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in sorted(values.items()):
+                lines.append("%s%s %s" % (name, _labels(names, labels), value))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+upstream_requests = registry.counter(
+    "evdrive_upstream_requests_total", "Upstream HTTP calls by service and final status", ("service", "status"))
+upstream_latency = registry.histogram(
+    "evdrive_upstream_request_seconds", "Upstream call latency including retries", ("service",))
+upstream_retries = registry.counter(
+    "evdrive_upstream_retries_total", "Upstream attempts retried after an error, 429 or 5xx", ("service",))
+upstream_rate_limited = registry.counter(
+    "evdrive_upstream_rate_limited_total", "Upstream 429 answers, before retrying", ("service",))
+over_query_limit = registry.counter(
+    "evdrive_over_query_limit_total", "Steps whose directions status was OVER_QUERY_LIMIT")
+http_latency = registry.histogram(
+    "evdrive_http_request_seconds", "API request latency by route and status", ("path", "status"))
+
+
+SERVICES = (   # (host part, path part, service)
+    ("locationiq.com", "/search", "geocoding"),
+    ("locationiq.com", "/directions", "directions"),
+    ("open-elevation.com", "", "elevation"),
+    ("openchargemap.io", "", "charging_stations"),
+)
+
+
+def service_of(url):
+    parts = urllib.parse.urlsplit(url)
+    for host, path, service in SERVICES:
+        if parts.netloc.endswith(host) and path in parts.path:
+            return service
+    return parts.netloc or "unknown"
+
+
+def cache_collector(name, stats):
+    # scrape-time hit/miss counters of a cache with a stats() method
+    def collect():
+        s = stats()
+        families = [
+            ("evdrive_cache_hits_total", "counter", "Cache lookups answered from the cache", ("cache",), {(name,): s.get("hits", 0)}),
+            ("evdrive_cache_misses_total", "counter", "Cache lookups that went upstream", ("cache",), {(name,): s.get("misses", 0)}),
+        ]
+        if "coalesced" in s:
+            families.append(("evdrive_cache_coalesced_total", "counter", "Lookups that joined a computation in flight",
+                             ("cache",), {(name,): s["coalesced"]}))
+        return families
+    return registry.collector(collect)
+
+
+def render():
+    return registry.render()
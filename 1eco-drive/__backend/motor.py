@@ -1,4 +1,5 @@
 import math
+import numpy as np
 
 class need_energy():
     def __init__(self):
@@ -19,4 +20,19 @@ class need_energy():
         p2 = 0.5 * self.air_density * self.front_area * self.aero_drag_coff * ((V - self.wind_speed)**2)
         p3 = self.mass * 9.8 * math.sin(rad)
         P = (p1 + p2 + p3) * V   # Watt
-        return P
\ No newline at end of file
+        return P
+
+    def energy_array(self, angle, V, wind_speed=None):
+        # same model as energy() over arrays of segments (any broadcastable shape,
+        # e.g. [segments] for one route or [routes, segments] for a batch).
+        # wind_speed is per segment, defaults to self.wind_speed; nothing on self is changed.
+        # Results equal energy() to within floating-point rounding (compare with np.allclose, not ==)
+        angle = np.asarray(angle, dtype=np.float64)
+        V = np.asarray(V, dtype=np.float64)
+        wind = self.wind_speed if wind_speed is None else np.asarray(wind_speed, dtype=np.float64)
+        rad = np.radians(angle)
+        p1 = (self.mass_factor * self.mass * self.acceleration) + (self.mass * 9.8 * self.coeff_roll_R * np.cos(rad))
+        p2 = 0.5 * self.air_density * self.front_area * self.aero_drag_coff * ((V - wind)**2)
+        p3 = self.mass * 9.8 * np.sin(rad)
+        P = (p1 + p2 + p3) * V   # Watt
+        return P
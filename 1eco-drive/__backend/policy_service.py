@@ -0,0 +1,114 @@
+import asyncio
+import os
+import re
+import numpy as np
+from actor_learner import greedy_actions
+
+CHECKPOINT_DIR = "./ev/model"   # where main.py saves model-<episode>.ckpt
+
+
+def latest_checkpoint(directory=CHECKPOINT_DIR):
+    # tf.train.latest_checkpoint without importing TensorFlow: the Saver's text
+    # "checkpoint" file names the newest model-<episode>.ckpt
+    try:
+        with open(os.path.join(directory, "checkpoint")) as f:
+            match = re.search(r'^model_checkpoint_path:\s*"(.*)"', f.read(), re.M)
+    except OSError:
+        return None
+    if match is None:
+        return None
+    path = match.group(1)
+    if not os.path.isabs(path):
+        path = os.path.join(directory, path)
+    return path if os.path.exists(path + ".index") else None
+
+
+def find_checkpoint(checkpoint=None):
+    # explicit path, else EVDRIVE_POLICY_CHECKPOINT, else the newest one main.py saved
+    checkpoint = checkpoint or os.environ.get("EVDRIVE_POLICY_CHECKPOINT")
+    return checkpoint or latest_checkpoint(CHECKPOINT_DIR)
+
+
+def load_weights(checkpoint, scope="Qnet"):   # Qnet's w1, b1, w2, b2, w3 as NumPy arrays, imports TensorFlow
+    import tensorflow as tf
+    reader = tf.train.load_checkpoint(checkpoint)
+    return [reader.get_tensor(scope + "/" + name) for name in ("w1", "b1", "w2", "b2", "w3")]
+
+
+class policy_batcher():
+    # Greedy Qnet actions for concurrent requests. predict() queues a state; the queue
+    # is flushed as one forward pass when max_batch states are waiting or max_wait
+    # seconds after the first one arrived, whichever comes first. Runs on the event loop.
+    def __init__(self, weights, max_batch=64, max_wait=0.002):
+        self.weights = weights
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = []
+        self.timer = None
+        self.batches = 0
+        self.states = 0
+
+    async def predict(self, state):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((state, future))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_wait, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+        if batch:
+            try:
+                actions = greedy_actions(self.weights, [state for state, _ in batch])
+            except Exception as e:   # runs in a loop callback: hand the error to the waiting requests
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future), action in zip(batch, actions):
+                    if not future.done():
+                        future.set_result(int(action))
+            self.batches += 1
+            self.states += len(batch)
+        if self.pending:
+            self.timer = asyncio.get_running_loop().call_soon(self.flush)
+
+    def stats(self):
+        return {"batches": self.batches, "states": self.states,
+                "avg_batch": self.states / self.batches if self.batches else 0.0}
+
+
+async def policy_rollout(env, batcher, max_step=200):
+    # Follow the greedy policy from env.start_position. Stops at the destination, after
+    # max_step steps, or when the policy stays put or comes back to a position it
+    # already visited (it is deterministic, so it would loop forever). env.step runs
+    # in a thread so the event loop keeps batching other requests.
+    env.current_position = env.start_position
+    env.battery_charge()
+    env.charge_num = 0
+    env.unreach_position_num = 0
+    env.time = 0
+    route = [tuple(env.start_position)]
+    visited = {route[0]}
+    total_reward = 0
+    d, charge_num, SOC = False, 0, env.battery.SOC
+    for _ in range(max_step):
+        action = await batcher.predict(np.array(env.current_position, dtype=np.float32))
+        s1, r, d, charge_num, SOC = await asyncio.to_thread(env.step, action)
+        total_reward = total_reward + r
+        position = tuple(s1)
+        if d:
+            route.append(position)
+            break
+        if position in visited:
+            break
+        route.append(position)
+        visited.add(position)
+    return {"reward": total_reward, "charge_num": charge_num, "SOC": SOC, "time": env.time,
+            "reached": bool(d), "route": [{"lat": lat, "lng": lng} for lat, lng in route]}
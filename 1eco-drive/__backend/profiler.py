@@ -0,0 +1,109 @@
+import contextlib
+import threading
+import time
+import metrics
+
+# Where the wall time of a training episode goes. Objects on the hot path
+# (environment, DoubleDQN) hold a `profiler` that is `disabled` by default, whose
+# phase() is a shared no-op context manager; main.py swaps in a phase_profiler
+# when profiling is switched on.
+PHASES = ("action", "env_step", "simulation", "replay_sample", "tf_update", "target_sync",
+          "buffer_save", "checkpoint", "sleep")
+UPSTREAM = tuple("upstream_" + service for _, _, service in metrics.SERVICES) + ("upstream_other",)
+COLUMNS = ("episode_wall",) + PHASES + UPSTREAM + ("other",)   # seconds, in result.csv order
+
+_NOTHING = contextlib.nullcontext()
+
+
+class null_profiler():
+    enabled = False
+
+    def phase(self, name):
+        return _NOTHING
+
+    def start_episode(self):
+        pass
+
+    def finish_episode(self):
+        return []
+
+    def close(self):
+        pass
+
+
+disabled = null_profiler()
+
+
+class _phase():
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.push(self.name)
+
+    def __exit__(self, *exc):
+        self.profiler.pop()
+
+
+class phase_profiler():
+    # Phases nest and time is exclusive: env_step does not include the simulation
+    # or the upstream calls made inside it. Upstream time is every provider call
+    # (retries and backoff included), taken from metrics.upstream_latency as it is
+    # observed. Phases running in worker threads (vector_environment) are summed
+    # over threads, so the phases of one episode can add up to more than its wall time.
+    enabled = True
+
+    def __init__(self):
+        self.totals = dict.fromkeys(PHASES + UPSTREAM, 0.0)
+        self.started = time.perf_counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        metrics.upstream_latency.listeners.append(self.upstream)
+
+    def phase(self, name):
+        return _phase(self, name)
+
+    def stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def push(self, name):
+        self.stack().append([name, time.perf_counter(), 0.0])   # name, start, time of nested phases
+
+    def pop(self):
+        stack = self.stack()
+        name, start, nested = stack.pop()
+        elapsed = time.perf_counter() - start
+        self.add(name, elapsed - nested)
+        if stack:
+            stack[-1][2] += elapsed
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    def upstream(self, seconds, service):
+        name = "upstream_" + service
+        self.add(name if name in self.totals else "upstream_other", seconds)
+        stack = self.stack()
+        if stack:
+            stack[-1][2] += seconds
+
+    def start_episode(self):
+        with self._lock:
+            self.totals = dict.fromkeys(PHASES + UPSTREAM, 0.0)
+        self.started = time.perf_counter()
+
+    def finish_episode(self):   # the COLUMNS of the episode that just ended
+        wall = time.perf_counter() - self.started
+        with self._lock:
+            totals = dict(self.totals)
+        spent = sum(totals.values())
+        return [wall] + [totals[name] for name in PHASES + UPSTREAM] + [max(wall - spent, 0.0)]
+
+    def close(self):
+        if self.upstream in metrics.upstream_latency.listeners:
+            metrics.upstream_latency.listeners.remove(self.upstream)
@@ -0,0 +1,413 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+import requests.adapters
+
+import metrics
+
+# Every call to LocationIQ, open-elevation and OpenChargeMap goes through the
+# provider configured here. Modes:
+#   live     talk to the real services
+#   record   talk to the real services and save every response to the fixture store
+#   replay   answer from the fixture store only; a missing fixture is a ConnectionError
+#   standin  send requests to a local StandinServer that serves the fixture store
+#            over HTTP with configurable latency and rate-limit errors
+# The mode and fixture directory default to $EVDRIVE_PROVIDER and $EVDRIVE_FIXTURES.
+# Real HTTP goes through one pooled keep-alive client per Provider with timeouts
+# and exponential backoff on 429/5xx (see Provider).
+MODES = ("live", "record", "replay", "standin")
+SECRET_PARAMS = ("key",)   # query parameters that never reach a fixture
+
+
+def strip_secrets(url):
+    parts = urllib.parse.urlsplit(url)
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True) if k not in SECRET_PARAMS]
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+
+class FixtureStore:
+    # one JSON file per request, named by a hash of method, url (without the api key) and payload
+    def __init__(self, directory="fixtures"):
+        self.directory = directory
+
+    def key(self, method, url, payload=None):
+        body = json.dumps(payload, sort_keys=True) if payload is not None else ""
+        return hashlib.sha1(f"{method.upper()} {strip_secrets(url)} {body}".encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def load(self, method, url, payload=None):
+        try:
+            with open(self.path(self.key(method, url, payload))) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, method, url, payload, status, body=None, text=None):
+        os.makedirs(self.directory, exist_ok=True)
+        fixture = {"method": method.upper(), "url": strip_secrets(url), "payload": payload,
+                   "status": status, "body": body, "text": text}
+        path = self.path(self.key(method, url, payload))
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(fixture, f)
+        os.replace(tmp, path)
+
+
+class FixtureResponse:
+    # the part of requests.Response the API methods use
+    def __init__(self, fixture, url):
+        self.status_code = fixture["status"]
+        self.url = url
+        self._body = fixture.get("body")
+        self.text = fixture.get("text") or (json.dumps(self._body) if self._body is not None else "")
+
+    def json(self):
+        if self._body is None:
+            return json.loads(self.text)
+        return self._body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error for url: {strip_secrets(self.url)}", response=self)
+
+
+RETRY_STATUS = (429, 500, 502, 503, 504)   # retried with exponential backoff
+
+# keep-alive sockets must not be shared with a forked child (actor_learner): a
+# child starts with no pooled connections of its own and leaves the inherited ones alone
+_providers = weakref.WeakSet()
+_inherited = []
+
+
+def _after_fork_in_child():
+    for provider in list(_providers):
+        _inherited.extend(c for c in (provider._session, provider._async_client) if c is not None)
+        provider._session = None
+        provider._session_lock = threading.Lock()
+        provider._async_client = None
+        provider._async_loop = None
+        provider._host_limits = {}
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class Provider:
+    # One pooled, keep-alive HTTP client shared by every provider call.
+    # timeout: (connect, read) seconds
+    # max_connections_per_host: size of the connection pool of each upstream host;
+    #                           callers wait for a free connection beyond it
+    # max_retries: retries on connection errors, timeouts and RETRY_STATUS responses,
+    #              sleeping a random time up to backoff_base * 2**attempt (capped at
+    #              backoff_max) or the Retry-After the service asked for
+    def __init__(self, mode="live", store=None, standin_url=None, timeout=(5, 30),
+                 max_connections_per_host=10, max_retries=4, backoff_base=0.5, backoff_max=60.0):
+        if mode not in MODES:
+            raise ValueError(f"Unknown provider mode '{mode}', expected one of {MODES}")
+        if mode == "standin" and not standin_url:
+            raise ValueError("standin mode needs the base url of a running StandinServer")
+        self.mode = mode
+        self.store = store if store is not None else FixtureStore()
+        self.standin_url = standin_url
+        self.timeout = timeout
+        self.max_connections_per_host = max_connections_per_host
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retries = 0
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._async_client = None
+        self._async_loop = None
+        self._host_limits = {}
+        _providers.add(self)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, json=None, **kwargs):
+        return self.request("POST", url, json=json, **kwargs)
+
+    def request(self, method, url, json=None, **kwargs):
+        # every call is counted and timed per service (see metrics)
+        service = metrics.service_of(url)
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = self.send(method, url, json, service, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            metrics.upstream_requests.inc(service, status)
+            metrics.upstream_latency.observe(time.perf_counter() - start, service)
+
+    def send(self, method, url, json, service, **kwargs):
+        if self.mode == "replay":
+            fixture = self.store.load(method, url, json)
+            if fixture is None:
+                raise requests.exceptions.ConnectionError(f"No fixture for {method} {strip_secrets(url)}")
+            return FixtureResponse(fixture, url)
+        target = standin_url_for(self.standin_url, url) if self.mode == "standin" else url
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            try:
+                response = self.session().request(method, target, json=json, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+                response = None
+            else:
+                if response.status_code == 429:
+                    metrics.upstream_rate_limited.inc(service)
+                if response.status_code not in RETRY_STATUS or attempt >= self.max_retries:
+                    break
+            metrics.upstream_retries.inc(service)
+            time.sleep(self.backoff(attempt, response))
+            attempt += 1
+        if self.mode == "record":
+            try:
+                body, text = response.json(), None
+            except ValueError:
+                body, text = None, response.text
+            self.store.save(method, url, json, response.status_code, body, text)
+        return response
+
+    def session(self):
+        # requests keeps one pool per host in the adapter; pool_block makes callers
+        # wait instead of opening connections beyond max_connections_per_host
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(
+                        pool_connections=16, pool_maxsize=self.max_connections_per_host, pool_block=True)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+        return self._session
+
+    def backoff(self, attempt, response=None):
+        self.retries += 1
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after is not None:
+            try:
+                delay = max(delay, min(float(retry_after), self.backoff_max))
+            except ValueError:
+                pass
+        return delay
+
+    async def aget(self, url, **kwargs):
+        return await self.arequest("GET", url, **kwargs)
+
+    async def apost(self, url, json=None, **kwargs):
+        return await self.arequest("POST", url, json=json, **kwargs)
+
+    async def arequest(self, method, url, json=None, **kwargs):
+        # asyncio counterpart of request() on httpx. Responses and errors look like
+        # the requests ones, so callers keep catching requests.exceptions.RequestException
+        if self.mode == "replay":
+            return self.request(method, url, json=json)
+        service = metrics.service_of(url)
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = await self.asend(method, url, json, service, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            metrics.upstream_requests.inc(service, status)
+            metrics.upstream_latency.observe(time.perf_counter() - start, service)
+
+    async def asend(self, method, url, json, service, **kwargs):
+        import httpx
+        target = standin_url_for(self.standin_url, url) if self.mode == "standin" else url
+        client = self.async_client()
+        host_limit = self._host_limits.setdefault(
+            urllib.parse.urlsplit(target).netloc, asyncio.Semaphore(self.max_connections_per_host))
+        attempt = 0
+        while True:
+            try:
+                async with host_limit:
+                    response = await client.request(method, target, json=json, **kwargs)
+            except httpx.HTTPError as e:
+                if attempt >= self.max_retries:
+                    raise requests.exceptions.ConnectionError(f"{type(e).__name__} for url: {strip_secrets(url)}")
+                response = None
+            else:
+                if response.status_code == 429:
+                    metrics.upstream_rate_limited.inc(service)
+                if response.status_code not in RETRY_STATUS or attempt >= self.max_retries:
+                    break
+            metrics.upstream_retries.inc(service)
+            await asyncio.sleep(self.backoff(attempt, response))
+            attempt += 1
+        fixture = {"status": response.status_code, "body": None, "text": response.text}
+        if self.mode == "record":
+            try:
+                fixture["body"], fixture["text"] = response.json(), None
+            except ValueError:
+                pass
+            self.store.save(method, url, json, fixture["status"], fixture["body"], fixture["text"])
+        return FixtureResponse(fixture, url)
+
+    def async_client(self):
+        # one client per event loop so its connection pool is reused by every request
+        import httpx
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            connect, read = self.timeout
+            self._async_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(read, connect=connect),
+                limits=httpx.Limits(max_keepalive_connections=self.max_connections_per_host))
+            self._async_loop = loop
+            self._host_limits = {}
+        return self._async_client
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+            self._async_loop = None
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+def standin_url_for(base_url, url):
+    # https://us1.locationiq.com/v1/search?q=x -> <base_url>/https/us1.locationiq.com/v1/search?q=x
+    parts = urllib.parse.urlsplit(url)
+    return urllib.parse.urlunsplit(urllib.parse.urlsplit(base_url)._replace(
+        path=f"/{parts.scheme}/{parts.netloc}{parts.path}", query=parts.query))
+
+
+class StandinServer:
+    # local HTTP stand-in for the upstream services, serving a FixtureStore.
+    # latency: seconds added to every response (plus up to `jitter` more)
+    # rate_limit: requests per second before answering 429, None for no limit
+    # error_rate: fraction of requests answered with 429 regardless of rate
+    def __init__(self, store, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, rate_limit=None, error_rate=0.0):
+        self.store = store
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.requests = 0
+        self.rate_limited = 0
+        self._window = (0, 0)   # (second, requests in that second)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _limited(self):
+        with self._lock:
+            self.requests += 1
+            second = int(time.monotonic())
+            count = self._window[1] + 1 if self._window[0] == second else 1
+            self._window = (second, count)
+            limited = (self.rate_limit is not None and count > self.rate_limit) or random.random() < self.error_rate
+            if limited:
+                self.rate_limited += 1
+            return limited
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.answer("GET", None)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                payload = json.loads(self.rfile.read(length)) if length else None
+                self.answer("POST", payload)
+
+            def answer(self, method, payload):
+                if server.latency or server.jitter:
+                    time.sleep(server.latency + random.uniform(0, server.jitter))
+                if server._limited():
+                    return self.send(429, json.dumps({"error": "Rate Limited Second"}))
+                _, scheme, rest = self.path.split("/", 2)
+                fixture = server.store.load(method, f"{scheme}://{rest}", payload)
+                if fixture is None:
+                    return self.send(404, json.dumps({"error": "No fixture"}))
+                text = fixture.get("text") if fixture.get("body") is None else json.dumps(fixture["body"])
+                self.send(fixture["status"], text or "")
+
+            def send(self, status, text):
+                data = text.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+provider = Provider(os.environ.get("EVDRIVE_PROVIDER", "live"),
+                    FixtureStore(os.environ.get("EVDRIVE_FIXTURES", "fixtures")),
+                    os.environ.get("EVDRIVE_STANDIN_URL"))
+
+
+def configure(mode="live", fixtures="fixtures", standin_url=None, **client_options):
+    # client_options: timeout, max_connections_per_host, max_retries, backoff_base, backoff_max
+    global provider
+    provider = Provider(mode, FixtureStore(fixtures), standin_url, **client_options)
+    return provider
+
+
+def get(url, **kwargs):
+    return provider.get(url, **kwargs)
+
+
+def post(url, json=None, **kwargs):
+    return provider.post(url, json=json, **kwargs)
+
+
+async def aget(url, **kwargs):
+    return await provider.aget(url, **kwargs)
+
+
+async def apost(url, json=None, **kwargs):
+    return await provider.apost(url, json=json, **kwargs)
@@ -0,0 +1,258 @@
+import json
+import os
+import numpy as np
+
+def transition_dtype(s_size = 2):
+    return np.dtype([('state', np.float32, (s_size,)), ('action', np.int8), ('reward', np.float32),
+                     ('next_state', np.float32, (s_size,)), ('done', bool)])
+
+class experience_replay_buffer():
+    # Preallocated ring buffer of (s, a, r, s', d) transitions.
+    # append is O(1); once `size` transitions are stored the oldest one is overwritten.
+    def __init__(self, size = 50000, s_size = 2):
+        self.buffersize = size
+        self.state = np.zeros((size, s_size), dtype=np.float32)
+        self.action = np.zeros(size, dtype=np.int8)
+        self.reward = np.zeros(size, dtype=np.float32)
+        self.next_state = np.zeros((size, s_size), dtype=np.float32)
+        self.done = np.zeros(size, dtype=bool)
+        self.position = 0   # slot of the next append
+        self.count = 0      # number of stored transitions
+        self.total = 0      # number of transitions ever appended
+        self.rng = np.random.default_rng()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, s, a, r, s1, d):
+        i = self.position
+        self.state[i] = s
+        self.action[i] = a
+        self.reward[i] = r
+        self.next_state[i] = s1
+        self.done[i] = d
+        self.position = (i + 1) % self.buffersize
+        self.count = min(self.count + 1, self.buffersize)
+        self.total += 1
+
+    def sample_index(self, num):
+        # distinct slots, like random.sample
+        return self.rng.choice(self.count, size=num, replace=False)
+
+    def batch(self, num):  # 5 output: s [num, s_size], a [num], r [num], s' [num, s_size], d [num]
+        idx = self.sample_index(num)
+        return self.state[idx], self.action[idx], self.reward[idx], self.next_state[idx], self.done[idx]
+
+    def latest(self, num):  # record array of the newest `num` transitions, oldest first
+        num = min(num, self.count)
+        idx = (self.position - num + np.arange(num)) % self.buffersize
+        records = np.empty(num, dtype=transition_dtype(self.state.shape[1]))
+        records['state'] = self.state[idx]
+        records['action'] = self.action[idx]
+        records['reward'] = self.reward[idx]
+        records['next_state'] = self.next_state[idx]
+        records['done'] = self.done[idx]
+        return records
+
+    def extend(self, records):  # bulk append of a transition record array
+        self.total += len(records)
+        records = records[-self.buffersize:]
+        idx = (self.position + np.arange(len(records))) % self.buffersize
+        self.state[idx] = records['state']
+        self.action[idx] = records['action']
+        self.reward[idx] = records['reward']
+        self.next_state[idx] = records['next_state']
+        self.done[idx] = records['done']
+        self.position = (self.position + len(records)) % self.buffersize
+        self.count = min(self.count + len(records), self.buffersize)
+
+
+
+class sum_tree():
+    # Binary tree over `size` leaf priorities where every node holds the sum of its
+    # children, stored heap-style in one array (root at 1, leaves at leaf0..).
+    # update and proportional lookup are O(log n) and vectorized over a batch.
+    def __init__(self, size):
+        self.size = size
+        self.leaf0 = 1 << max(int(size - 1).bit_length(), 0)
+        self.tree = np.zeros(2 * self.leaf0, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def update(self, idx, priority):
+        nodes = np.asarray(idx, dtype=np.int64) + self.leaf0
+        self.tree[nodes] = priority   # with duplicates the last one wins, like sequential updates
+        tree = self.tree
+        if len(nodes) == 1:   # single append: plain ints are much cheaper than tiny arrays
+            node = int(nodes[0]) // 2
+            while node >= 1:
+                tree[node] = tree[2 * node] + tree[2 * node + 1]
+                node //= 2
+            return
+        nodes = nodes // 2
+        while nodes[0] >= 1:   # a parent listed twice just gets the same sum twice
+            tree[nodes] = tree[2 * nodes] + tree[2 * nodes + 1]
+            nodes = nodes // 2
+
+    def find(self, values):   # leaf index whose cumulative priority range holds each value
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        while nodes[0] < self.leaf0:
+            left = self.tree[2 * nodes]
+            right = values >= left
+            values -= np.where(right, left, 0)
+            nodes = 2 * nodes + right
+        return nodes - self.leaf0
+
+    def priority(self, idx):
+        return self.tree[np.asarray(idx, dtype=np.int64) + self.leaf0]
+
+
+class prioritized_replay_buffer(experience_replay_buffer):
+    # experience_replay_buffer sampled in proportion to priority ** alpha, with
+    # priority = |TD error| + eps from the last training step on that transition
+    # (new ones get the highest priority seen so far). sample() also returns the
+    # importance-sampling weights (N * P(i)) ** -beta / max, beta annealed to 1.
+    prioritized = True
+
+    def __init__(self, size = 50000, s_size = 2, alpha = 0.6, beta = 0.4, beta_steps = 100000, eps = 1e-3):
+        super().__init__(size, s_size)
+        self.tree = sum_tree(size)
+        self.alpha = alpha
+        self.beta0 = beta
+        self.beta_steps = beta_steps
+        self.eps = eps
+        self.max_priority = 1.0
+        self.samples = 0   # sample() calls, for the beta schedule
+
+    def append(self, s, a, r, s1, d):
+        i = self.position
+        super().append(s, a, r, s1, d)
+        self.tree.update([i], self.max_priority ** self.alpha)
+
+    def extend(self, records):
+        n = min(len(records), self.buffersize)
+        idx = (self.position + np.arange(n)) % self.buffersize
+        super().extend(records)
+        if n:
+            self.tree.update(idx, self.max_priority ** self.alpha)
+
+    def beta(self):
+        return min(1.0, self.beta0 + (1.0 - self.beta0) * self.samples / self.beta_steps)
+
+    def sample(self, num):  # 3 output: (s, a, r, s', d), slots [num], IS weights [num]
+        # one draw from each of num equal slices of the total priority
+        total = self.tree.total()
+        values = (np.arange(num) + self.rng.random(num)) * (total / num)
+        idx = np.minimum(self.tree.find(np.minimum(values, np.nextafter(total, 0))), self.count - 1)
+        prob = self.tree.priority(idx) / total
+        weights = (self.count * prob) ** -self.beta()
+        weights = (weights / weights.max()).astype(np.float32)
+        self.samples += 1
+        batch = (self.state[idx], self.action[idx], self.reward[idx], self.next_state[idx], self.done[idx])
+        return batch, idx, weights
+
+    def update_priorities(self, idx, td_error):
+        priority = np.abs(np.asarray(td_error, dtype=np.float64)) + self.eps
+        self.max_priority = max(self.max_priority, float(priority.max()))
+        self.tree.update(idx, priority ** self.alpha)
+
+class buffer_store():
+    # Append-only binary persistence for experience_replay_buffer.
+    # Every save() writes only the transitions appended since the last save as a new
+    # .npy segment, then commits by atomically replacing manifest.json. A crash before
+    # the manifest is replaced leaves the previous commit intact. Segments that only
+    # hold transitions already evicted from the ring are dropped. Segment files the
+    # committed manifest does not list (left by a crash mid-save) are deleted by
+    # load() and reset().
+    def __init__(self, directory = "./ev/buffer"):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self.manifest = self.read_manifest()
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"segments": [], "total": 0}
+
+    def write_manifest(self, manifest):
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.manifest_path)
+        self.sync_directory()
+        self.manifest = manifest
+
+    def sync_directory(self):  # make the renames in the directory durable, where the OS allows it
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def remove(self, segment):  # a segment already gone is fine, it is no longer listed
+        try:
+            os.remove(os.path.join(self.directory, segment["file"]))
+        except FileNotFoundError:
+            pass
+
+    def remove_orphans(self):  # segment files, finished or not, that the manifest does not list
+        if not os.path.isdir(self.directory):
+            return
+        listed = {segment["file"] for segment in self.manifest["segments"]}
+        for name in os.listdir(self.directory):
+            if name.startswith("segment-") and name.endswith((".npy", ".npy.tmp")) and name not in listed:
+                self.remove({"file": name})
+
+    def reset(self):  # drop everything saved so far, e.g. when training starts from scratch
+        old = self.manifest["segments"]
+        if os.path.isdir(self.directory):
+            self.write_manifest({"segments": [], "total": 0})
+        self.manifest = {"segments": [], "total": 0}
+        for segment in old:
+            self.remove(segment)
+        self.remove_orphans()
+
+    def save(self, buffer):  # number of transitions written
+        new = buffer.total - self.manifest["total"]
+        if new <= 0:
+            return 0
+        os.makedirs(self.directory, exist_ok=True)
+        records = buffer.latest(new)
+        name = "segment-%010d.npy" % buffer.total
+        tmp = os.path.join(self.directory, name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, records)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.directory, name))
+
+        segments = self.manifest["segments"] + [{"file": name, "count": len(records)}]
+        dropped = []
+        while len(segments) > 1 and sum(s["count"] for s in segments[1:]) >= buffer.buffersize:
+            dropped.append(segments.pop(0))
+        self.write_manifest({"segments": segments, "total": buffer.total})
+        for segment in dropped:
+            self.remove(segment)
+        return len(records)
+
+    def load(self, buffer):  # number of transitions loaded
+        # segments are memory-mapped and copied into the ring in bulk, newest buffersize kept
+        self.remove_orphans()
+        loaded = 0
+        for segment in self.manifest["segments"]:
+            records = np.load(os.path.join(self.directory, segment["file"]), mmap_mode='r')
+            buffer.extend(records)
+            loaded += len(records)
+        buffer.total = self.manifest["total"]
+        return min(loaded, buffer.buffersize)
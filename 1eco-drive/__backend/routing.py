@@ -0,0 +1,194 @@
+import heapq
+import itertools
+import math
+import numpy as np
+from haversine import haversine
+from battery import lithium_ion_battery
+
+OBJECTIVES = ("energy", "time")
+
+
+class route_graph():
+    # Directed road graph built from cached directions steps, plus charging-station
+    # nodes linked to the nearby road nodes. Edge costs use the same motor model as
+    # environment.step (env.leg_segments), energy in Wh = int(duration) * power / 3600.
+    # route() runs A* over (node, SOC bucket): an edge is only taken if the battery
+    # stays above 0.2 SOC after it, and at a station the battery can be charged to full.
+    def __init__(self, precision=5, capacity=50000, soc_buckets=40, charge_time=1800, link_km=0.5, link_speed=8.0):
+        self.precision = precision          # node positions are rounded like the caches (5 ~ 1 m)
+        self.battery = lithium_ion_battery(capacity)
+        self.soc_buckets = soc_buckets
+        self.charge_time = charge_time      # s spent per charging stop
+        self.link_km = link_km              # stations are linked to road nodes this close
+        self.link_speed = link_speed        # m/s driven on a station link
+        self.nodes = []                     # node id -> (lat, lng)
+        self.index = {}                     # rounded (lat, lng) -> node id
+        self.edges = []                     # node id -> {to: (duration, distance, energy)}
+        self.stations = {}                  # node id -> station info
+        self.coords = None                  # [nodes, 2] array for nearest(), rebuilt lazily
+        self.max_speed = 0.0                # m/s over all edges, for the time heuristic
+        self.min_energy = math.inf          # Wh per m over all edges, for the energy heuristic
+
+    @classmethod
+    def build(cls, env, routes=None, stations=(), **kwargs):
+        # routes: step lists in directions_parse format, default every route in env's directions cache
+        graph = cls(**kwargs)
+        routes = env.directions_cache.routes() if routes is None else routes
+        for steps in routes:
+            graph.add_route(env, steps)
+        for station in stations:
+            graph.add_station(env, station)
+        return graph
+
+    def node(self, position):
+        key = (round(float(position[0]), self.precision), round(float(position[1]), self.precision))
+        if key not in self.index:
+            self.index[key] = len(self.nodes)
+            self.nodes.append(key)
+            self.edges.append({})
+            self.coords = None
+        return self.index[key]
+
+    def add_edge(self, a, b, duration, distance, energy):
+        if a == b:
+            return
+        old = self.edges[a].get(b)
+        if old is None or energy < old[2]:
+            self.edges[a][b] = (duration, distance, energy)
+        if duration > 0 and distance > 0:
+            self.max_speed = max(self.max_speed, distance / duration)
+            self.min_energy = min(self.min_energy, energy / distance)
+
+    def add_route(self, env, steps):
+        if not steps:
+            return
+        for start, end, duration, distance, angle, speed, power in env.leg_segments(steps):
+            self.add_edge(self.node(start), self.node(end), duration, distance, int(duration) * power / 3600)
+
+    def add_station(self, env, station):
+        # station: a chargingstation_api entry (needs "Latitude" and "Longitude")
+        position = (station["Latitude"], station["Longitude"])
+        if position[0] is None or position[1] is None:
+            return
+        key = (round(float(position[0]), self.precision), round(float(position[1]), self.precision))
+        if self.index.get(key) in self.stations:
+            return
+        roads = [i for i, km in self.nearby(position, self.link_km, k=3) if i not in self.stations]
+        s = self.node(position)
+        self.stations[s] = station
+        links = []
+        for road in roads:
+            meters = haversine(position, self.nodes[road]) * 1000
+            duration = max(meters / self.link_speed, 1)
+            for a, b in ((s, road), (road, s)):
+                links.append((a, b, {"start_location": {"lat": self.nodes[a][0], "lng": self.nodes[a][1]},
+                                     "end_location": {"lat": self.nodes[b][0], "lng": self.nodes[b][1]},
+                                     "distance": {"value": meters}, "duration": {"value": duration}}))
+        if links:   # flat links, no elevation lookup
+            segments = env.leg_segments([step for a, b, step in links], heights=[(0, 0)] * len(links))
+            for (a, b, step), segment in zip(links, segments):
+                duration, distance, power = segment[2], segment[3], segment[6]
+                self.add_edge(a, b, duration, distance, int(duration) * power / 3600)
+
+    def distances_km(self, position):   # distance from position to every node
+        if self.coords is None:
+            self.coords = np.array(self.nodes, dtype=np.float64)
+        lat, lng = position
+        # equirectangular distance is plenty at these scales
+        dy = np.radians(self.coords[:, 0] - lat)
+        dx = np.radians(self.coords[:, 1] - lng) * math.cos(math.radians(lat))
+        return 6371.0088 * np.sqrt(dx * dx + dy * dy)
+
+    def nearby(self, position, km, k=None):  # [(node id, km)] within km of position, nearest first
+        if not self.nodes:
+            return []
+        dist = self.distances_km(position)
+        order = np.argsort(dist)
+        if k is not None:
+            order = order[:k]
+        return [(int(i), float(dist[i])) for i in order if dist[i] <= km]
+
+    def nearest(self, position, km=1.0):  # node id, or None if nothing is within km
+        found = self.nearby(position, km, k=1)
+        return found[0][0] if found else None
+
+    def heuristic(self, goal, objective):   # lower bound of the remaining cost, per node
+        meters = self.distances_km(self.nodes[goal]) * 1000
+        if objective == "time":
+            return (meters / self.max_speed).tolist() if self.max_speed > 0 else [0.0] * len(self.nodes)
+        return (meters * self.min_energy).tolist() if self.min_energy < math.inf else [0.0] * len(self.nodes)
+
+    def route(self, origin, destination, objective="energy", capacity=None, snap_km=1.0):
+        # origin, destination: (lat, lng). capacity: Wh at the start, default a full battery.
+        # returns None when either end is off the graph or no feasible path exists
+        if objective not in OBJECTIVES:
+            raise ValueError("objective must be one of %s" % (OBJECTIVES,))
+        start, goal = self.nearest(origin, snap_km), self.nearest(destination, snap_km)
+        if start is None or goal is None:
+            return None
+        total = self.battery.total_capacity
+        threshold = 0.2 * total          # lithium_ion_battery.use asks for a charge at SOC <= 0.2
+        bucket = total / self.soc_buckets
+        capacity = total if capacity is None else capacity
+        h = self.heuristic(goal, objective)
+        by_energy = objective == "energy"
+        tie = itertools.count()
+
+        first = (start, int(capacity // bucket))
+        labels = {first: (0.0, capacity, None, False)}   # state -> (cost, Wh left, previous state, charged here)
+        settled = {}                                     # node -> [(cost, Wh left)] already expanded
+        heap = [(h[start], next(tie), first)]
+        while heap:
+            _, _, state = heapq.heappop(heap)
+            cost, left = labels[state][0], labels[state][1]
+            node = state[0]
+            # skip labels beaten at this node by one that is as cheap and has as much charge
+            if any(c <= cost and l >= left for c, l in settled.get(node, ())):
+                continue
+            settled.setdefault(node, []).append((cost, left))
+            if node == goal:
+                return self.path(labels, state, objective)
+            moves = [(to, left - energy, energy if by_energy else duration, False)
+                     for to, (duration, distance, energy) in self.edges[node].items()]
+            if node in self.stations and left < total:
+                moves.append((node, total, 0.0 if by_energy else self.charge_time, True))
+            for to, new_left, step_cost, charged in moves:
+                if new_left <= threshold:
+                    continue
+                new_state = (to, int(new_left // bucket))
+                new_cost = cost + step_cost
+                old = labels.get(new_state)
+                if old is not None and old[0] <= new_cost:
+                    continue
+                labels[new_state] = (new_cost, new_left, state, charged)
+                heapq.heappush(heap, (new_cost + h[to], next(tie), new_state))
+        return None
+
+    def path(self, labels, state, objective):
+        states = []
+        while state is not None:
+            states.append(state)
+            state = labels[state][2]
+        states.reverse()
+        route, charging = [self.nodes[states[0][0]]], []
+        time = distance = energy = 0.0
+        for prev, cur in zip(states, states[1:]):
+            if labels[cur][3]:
+                charging.append(self.nodes[cur[0]])
+                time += self.charge_time
+                continue
+            duration, dist, wh = self.edges[prev[0]][cur[0]]
+            time += duration
+            distance += dist
+            energy += wh
+            route.append(self.nodes[cur[0]])
+        return {
+            "objective": objective,
+            "route": [{"lat": lat, "lng": lng} for lat, lng in route],
+            "time": time,
+            "distance": distance,
+            "energy": energy,
+            "charge_num": len(charging),
+            "charging": [{"lat": lat, "lng": lng} for lat, lng in charging],
+            "SOC": min(labels[states[-1]][1] / self.battery.total_capacity, 0.9),
+        }
@@ -0,0 +1,299 @@
+import json
+import math
+import os
+import threading
+import time
+import weakref
+import numpy as np
+import requests
+import providers
+from cache import _open_db
+
+OPENCHARGEMAP_URL = "https://api.openchargemap.io/v3/poi/"
+EARTH_RADIUS_KM = 6371.0088
+
+
+def parse_station(station):   # one OpenChargeMap POI -> the station dict the APIs return
+    address = station.get("AddressInfo") or {}
+    return {
+        "Name": address.get("Title", "Unknown"),
+        "Address": address.get("AddressLine1", "No address"),
+        "Latitude": address.get("Latitude"),
+        "Longitude": address.get("Longitude"),
+        "Usage Type": (station.get("UsageType") or {}).get("Title", "Unknown"),
+        "Status": (station.get("StatusType") or {}).get("Title", "Unknown"),
+        "Number of Connections": len(station.get("Connections") or []),
+    }
+
+
+def store_station(station):   # parse_station plus the POI ID, which the store deduplicates regions by
+    return dict(parse_station(station), ID=station.get("ID"))
+
+
+def distance_km(coords, position):   # haversine from position to every row of coords [n, 2]
+    lat1, lng1 = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+    lat2, lng2 = math.radians(position[0]), math.radians(position[1])
+    a = np.sin((lat1 - lat2) / 2) ** 2 + np.cos(lat1) * math.cos(lat2) * np.sin((lng1 - lng2) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+# like cache.py: a forked child opens its own SQLite connection and has no refresh thread
+_stores = weakref.WeakSet()
+_inherited = []
+
+
+def _after_fork_in_child():
+    for store in list(_stores):
+        if store._conn is not None:
+            _inherited.append(store._conn)
+            store._conn = None
+        store._lock = threading.Lock()
+        store._load_lock = threading.Lock()
+        store._thread = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class station_index():
+    # Uniform lat/lng grid over the station coordinates (like a fixed-precision
+    # geohash). A query only looks at the cells around the point, growing ring by
+    # ring until no unseen cell can hold anything closer.
+    def __init__(self, stations, cell_deg=0.05):
+        self.stations = [s for s in stations if s["Latitude"] is not None and s["Longitude"] is not None]
+        self.cell_deg = cell_deg
+        self.coords = np.array([(s["Latitude"], s["Longitude"]) for s in self.stations], dtype=np.float64).reshape(-1, 2)
+        cells = np.floor(self.coords / cell_deg).astype(np.int64)
+        order = np.lexsort((cells[:, 1], cells[:, 0]))
+        self.order = order
+        self.cells = {}   # (row, col) -> indices into self.stations
+        if len(order):
+            keys = cells[order]
+            change = np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1
+            for start, end in zip(np.r_[0, change], np.r_[change, len(order)]):
+                self.cells[(int(keys[start, 0]), int(keys[start, 1]))] = order[start:end]
+        self.rows = (cells[:, 0].min(), cells[:, 0].max()) if len(order) else (0, -1)
+        self.cols = (cells[:, 1].min(), cells[:, 1].max()) if len(order) else (0, -1)
+
+    def __len__(self):
+        return len(self.stations)
+
+    def cell_km(self, lat):   # smallest side of a cell near lat
+        lat = min(abs(lat) + self.cell_deg, 89.9)
+        return self.cell_deg * math.pi / 180 * EARTH_RADIUS_KM * math.cos(math.radians(lat))
+
+    def ring(self, row, col, r):   # indices of the stations in the cells exactly r cells away
+        if r == 0:
+            found = self.cells.get((row, col))
+            return [] if found is None else [found]
+        out = []
+        for c in range(col - r, col + r + 1):
+            for rr in (row - r, row + r):
+                found = self.cells.get((rr, c))
+                if found is not None:
+                    out.append(found)
+        for rr in range(row - r + 1, row + r):
+            for c in (col - r, col + r):
+                found = self.cells.get((rr, c))
+                if found is not None:
+                    out.append(found)
+        return out
+
+    def max_ring(self, row, col):   # ring beyond which there are no cells
+        return max(abs(row - self.rows[0]), abs(row - self.rows[1]), abs(col - self.cols[0]), abs(col - self.cols[1]))
+
+    def results(self, idx):   # closest first, with the keys of parse_station like the network path
+        return [{key: value for key, value in self.stations[i].items() if key != "ID"} for i in idx]
+
+    def nearest(self, position, k=1):   # the k closest stations, closest first
+        if not self.stations:
+            return []
+        row, col = (int(v) for v in np.floor(np.asarray(position, dtype=np.float64) / self.cell_deg))
+        step_km = self.cell_km(position[0])
+        last = self.max_ring(row, col)
+        found = []
+        for r in range(last + 1):
+            if 8 * r > len(self.stations):   # far from every station: scanning them all is cheaper
+                found = [np.arange(len(self.stations))]
+                break
+            found.extend(self.ring(row, col, r))
+            if found and sum(len(f) for f in found) >= k:
+                idx = np.concatenate(found)
+                dist = distance_km(self.coords[idx], position)
+                if len(idx) > k:
+                    part = np.argpartition(dist, k - 1)[:k]
+                    idx, dist = idx[part], dist[part]
+                if dist.max() <= r * step_km:   # nothing in ring r + 1 can be closer
+                    break
+        idx = np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+        dist = distance_km(self.coords[idx], position)
+        best = np.argsort(dist)[:k]
+        return self.results(idx[best])
+
+    def within(self, position, km, max_results=None):   # stations within km, closest first
+        if not self.stations:
+            return []
+        row, col = (int(v) for v in np.floor(np.asarray(position, dtype=np.float64) / self.cell_deg))
+        rings = min(int(math.ceil(km / self.cell_km(position[0]))) + 1, self.max_ring(row, col))
+        found = [f for r in range(rings + 1) for f in self.ring(row, col, r)]
+        if not found:
+            return []
+        idx = np.concatenate(found)
+        dist = distance_km(self.coords[idx], position)
+        keep = dist <= km
+        idx, dist = idx[keep], dist[keep]
+        best = np.argsort(dist)[:max_results]
+        return self.results(idx[best])
+
+
+class charging_station_store():
+    # Charging stations bulk-loaded from OpenChargeMap per bounding box (for example
+    # env.map_bound) and answered locally from a station_index. Regions are kept in
+    # SQLite so later runs start warm, and are reloaded once older than `ttl`, by
+    # refresh() or by the background thread of start_refresh(). The saved regions
+    # are read on first use (or ensure_loaded()), not when the store is created.
+    def __init__(self, path=None, api_key="0a679e06-9fa6-4b80-83e1-8abb7f83a6e9", ttl=24 * 3600,
+                 cell_deg=0.05, max_results=10000):
+        self.path = path
+        self.api_key = api_key
+        self.ttl = ttl
+        self.cell_deg = cell_deg
+        self.max_results = max_results
+        self.regions = {}     # key -> {"bound": bound, "fetched": time, "stations": [...]}
+        self.index = station_index([], cell_deg)
+        self._conn = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._loaded = path is None
+        self._load_lock = threading.Lock()
+        _stores.add(self)
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            with self._load_lock:
+                if not self._loaded:
+                    if os.path.exists(self.path):
+                        self.read_regions()
+                    self._loaded = True
+
+    @staticmethod
+    def key(bound):
+        return "%.3f,%.3f,%.3f,%.3f" % (bound["north"], bound["west"], bound["south"], bound["east"])
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = _open_db(
+                self.path,
+                "CREATE TABLE IF NOT EXISTS stations ("
+                "region TEXT PRIMARY KEY, fetched REAL, bound TEXT, stations TEXT)",
+            )
+        return self._conn
+
+    def read_regions(self):
+        with self._lock:
+            rows = self._connect().execute("SELECT region, fetched, bound, stations FROM stations").fetchall()
+        for region, fetched, bound, stations in rows:
+            self.regions[region] = {"bound": json.loads(bound), "fetched": fetched, "stations": json.loads(stations)}
+        self.rebuild()
+
+    def rebuild(self):   # one index over every region, stations deduplicated by ID
+        with self._lock:
+            merged = {}
+            for region in self.regions.values():
+                for station in region["stations"]:
+                    merged[station["ID"] if station["ID"] is not None else (station["Latitude"], station["Longitude"])] = station
+            self.index = station_index(list(merged.values()), self.cell_deg)   # swapped in one assignment
+
+    def fetch(self, bound):   # every station inside bound, None if the request failed
+        url = (f"{OPENCHARGEMAP_URL}?key={self.api_key}"
+               f"&boundingbox=({bound['north']},{bound['west']}),({bound['south']},{bound['east']})"
+               f"&maxresults={self.max_results}&compact=true&verbose=false")
+        try:
+            response = providers.get(url)
+            response.raise_for_status()
+            return [store_station(station) for station in response.json()]
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"ERROR: Charging station bulk load failed - {e}")
+            return None
+
+    def load(self, bound, force=False):   # number of stations in the region, None if it could not be loaded
+        self.ensure_loaded()
+        key = self.key(bound)
+        region = self.regions.get(key)
+        if region is not None and not force and time.time() - region["fetched"] < self.ttl:
+            return len(region["stations"])
+        stations = self.fetch(bound)
+        if stations is None:
+            return None if region is None else len(region["stations"])
+        fetched = time.time()
+        with self._lock:
+            self.regions[key] = {"bound": dict(bound), "fetched": fetched, "stations": stations}
+            if self.path is not None:
+                conn = self._connect()
+                conn.execute("INSERT OR REPLACE INTO stations VALUES (?, ?, ?, ?)",
+                             (key, fetched, json.dumps(bound), json.dumps(stations)))
+                conn.commit()
+        self.rebuild()
+        return len(stations)
+
+    def refresh(self):   # reload every region older than ttl
+        self.ensure_loaded()
+        for region in list(self.regions.values()):
+            if time.time() - region["fetched"] >= self.ttl:
+                self.load(region["bound"], force=True)
+
+    def start_refresh(self, interval=3600):
+        if self._thread is not None:
+            return
+        def run():
+            while not self._stop.wait(interval):
+                self.refresh()
+        self._thread = threading.Thread(target=run, name="station-refresh", daemon=True)
+        self._thread.start()
+
+    def stop_refresh(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def covers(self, position, km=0.0):   # True when a loaded region holds the whole circle
+        self.ensure_loaded()
+        margin_lat = km / 111.2
+        margin_lng = km / (111.2 * max(math.cos(math.radians(position[0])), 1e-6))
+        with self._lock:   # load() adds regions from the refresh thread and request threads
+            regions = list(self.regions.values())
+        for region in regions:
+            b = region["bound"]
+            if (b["south"] <= position[0] - margin_lat and position[0] + margin_lat <= b["north"] and
+                    b["west"] <= position[1] - margin_lng and position[1] + margin_lng <= b["east"]):
+                return True
+        return False
+
+    def nearest(self, position, k=1):
+        self.ensure_loaded()
+        return self.index.nearest(position, k)
+
+    def within(self, position, km, max_results=None):
+        self.ensure_loaded()
+        return self.index.within(position, km, max_results)
+
+    def in_bound(self, bound):   # stations inside a map bound
+        self.ensure_loaded()
+        index = self.index
+        lat, lng = index.coords[:, 0], index.coords[:, 1]
+        keep = np.flatnonzero((lat <= bound["north"]) & (lat >= bound["south"]) & (lng <= bound["east"]) & (lng >= bound["west"]))
+        return [index.stations[i] for i in keep]
+
+    def stations(self):
+        self.ensure_loaded()
+        return list(self.index.stations)
+
+    def close(self):
+        self.stop_refresh()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
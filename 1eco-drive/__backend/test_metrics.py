@@ -0,0 +1,18 @@
+import metrics
+
+
+def test_render_mixed_status_labels():
+    registry = metrics.Registry()
+    requests = registry.counter("test_requests_total", "Test calls", ("service", "status"))
+    latency = registry.histogram("test_request_seconds", "Test latency", ("path", "status"))
+    requests.inc("elevation", 200)
+    requests.inc("elevation", "error")
+    latency.observe(0.01, "/route", 200)
+    latency.observe(0.02, "/route", "error")
+
+    text = registry.render()
+
+    assert 'test_requests_total{service="elevation",status="200"} 1' in text
+    assert 'test_requests_total{service="elevation",status="error"} 1' in text
+    assert 'test_request_seconds_count{path="/route",status="200"} 1' in text
+    assert 'test_request_seconds_count{path="/route",status="error"} 1' in text
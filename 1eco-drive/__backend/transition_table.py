@@ -0,0 +1,152 @@
+import math
+import numpy as np
+
+# action is in the set of (0,1,2,3) = (north, east, south, west)
+ACTION_MOVES = ((1, 0), (0, 1), (-1, 0), (0, -1))   # (row, col) offset per action
+
+
+class transition_table():
+    # Every (cell, action) of the training grid, precomputed once with the live
+    # APIs so environment.step can run as an array lookup plus the battery update.
+    # The grid is anchored at the start position with the strides of
+    # environment.stride_length(start_position); cell (row, col) is at
+    # (lat0 + row * stride_height, lng0 + col * stride_wide).
+    # Per transition t = (row index, col index, action) flattened:
+    #   reachable, goal       bool
+    #   time, distance        s, m summed over every driven segment
+    #   energy                Wh with no recharge, reward the matching step reward
+    #   seg_offset[t]:seg_offset[t+1]   the driven segments (duration, power) and
+    #                                   whether their battery penalty counts in the reward
+    def __init__(self, origin, stride, row_min, col_min, shape, arrays):
+        self.origin = tuple(origin)          # (lat0, lng0)
+        self.stride = tuple(stride)          # (stride_height, stride_wide) in degree
+        self.row_min = int(row_min)
+        self.col_min = int(col_min)
+        self.shape = tuple(shape)            # (rows, cols)
+        self.reachable = arrays['reachable']
+        self.goal = arrays['goal']
+        self.time = arrays['time']
+        self.distance = arrays['distance']
+        self.energy = arrays['energy']
+        self.reward = arrays['reward']
+        self.seg_offset = arrays['seg_offset']
+        self.seg_duration = arrays['seg_duration']
+        self.seg_power = arrays['seg_power']
+        self.seg_scored = arrays['seg_scored']
+
+    def position(self, cell):  # (row, col) -> (lat, lng)
+        return (self.origin[0] + cell[0] * self.stride[0], self.origin[1] + cell[1] * self.stride[1])
+
+    def cell_of(self, position):  # (lat, lng) -> (row, col), the nearest grid cell
+        return (int(round((position[0] - self.origin[0]) / self.stride[0])),
+                int(round((position[1] - self.origin[1]) / self.stride[1])))
+
+    def in_grid(self, cell):
+        return (0 <= cell[0] - self.row_min < self.shape[0]) and (0 <= cell[1] - self.col_min < self.shape[1])
+
+    def index(self, cell, action):  # flat transition index, None outside the grid
+        if not self.in_grid(cell):
+            return None
+        return ((cell[0] - self.row_min) * self.shape[1] + (cell[1] - self.col_min)) * 4 + int(action)
+
+    def next_cell(self, cell, action):
+        move = ACTION_MOVES[int(action)]
+        return (cell[0] + move[0], cell[1] + move[1])
+
+    def segments(self, t):  # (duration, power, scored) of transition t
+        k0, k1 = self.seg_offset[t], self.seg_offset[t + 1]
+        return self.seg_duration[k0:k1], self.seg_power[k0:k1], self.seg_scored[k0:k1]
+
+    def save(self, path):
+        np.savez_compressed(
+            path,
+            origin=np.array(self.origin), stride=np.array(self.stride),
+            row_min=self.row_min, col_min=self.col_min, shape=np.array(self.shape),
+            reachable=self.reachable, goal=self.goal, time=self.time, distance=self.distance,
+            energy=self.energy, reward=self.reward, seg_offset=self.seg_offset,
+            seg_duration=self.seg_duration, seg_power=self.seg_power, seg_scored=self.seg_scored,
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['origin'], data['stride'], data['row_min'], data['col_min'], data['shape'], data)
+
+    @classmethod
+    def build(cls, env):
+        # walk every cell and action once with env's (cached) directions and elevation APIs.
+        # env.length must already be set to the training stride.
+        env.stride_length(env.start_position)
+        stride_height, stride_wide = env.stride_height, env.stride_wide
+        lat0, lng0 = env.start_position
+        bound = env.map_bound
+        row_min = min(0, math.ceil((bound['south'] - lat0) / stride_height))
+        row_max = max(0, math.floor((bound['north'] - lat0) / stride_height))
+        col_min = min(0, math.ceil((bound['west'] - lng0) / stride_wide))
+        col_max = max(0, math.floor((bound['east'] - lng0) / stride_wide))
+        shape = (row_max - row_min + 1, col_max - col_min + 1)
+        n = shape[0] * shape[1] * 4
+        print("DEBUG: Precomputing", n, "transitions on a", shape, "grid")
+
+        reachable = np.zeros(n, dtype=bool)
+        goal = np.zeros(n, dtype=bool)
+        time = np.zeros(n, dtype=np.float32)
+        distance = np.zeros(n, dtype=np.float32)
+        energy = np.zeros(n, dtype=np.float32)
+        reward = np.full(n, -1, dtype=np.float32)
+        seg_offset = np.zeros(n + 1, dtype=np.int64)
+        seg_duration, seg_power, seg_scored = [], [], []
+        end_position = f"{env.end_position[0]},{env.end_position[1]}"
+
+        t = 0
+        for row in range(row_min, row_max + 1):
+            for col in range(col_min, col_max + 1):
+                current = (lat0 + row * stride_height, lng0 + col * stride_wide)
+                for action, move in enumerate(ACTION_MOVES):
+                    seg_offset[t] = len(seg_duration)
+                    nxt = (lat0 + (row + move[0]) * stride_height, lng0 + (col + move[1]) * stride_wide)
+                    if (nxt[0] > bound['north'] or nxt[0] < bound['south'] or
+                            nxt[1] > bound['east'] or nxt[1] < bound['west']):
+                        t += 1
+                        continue
+                    next_position = f"{nxt[0]},{nxt[1]}"
+                    status, leg_step, _ = env.directions_api(f"{current[0]},{current[1]}", next_position)
+                    retry_count = 0
+                    while status != 'OK' and retry_count < 3:
+                        status, leg_step, _ = env.directions_api(f"{current[0]},{current[1]}", next_position)
+                        retry_count += 1
+                    if status != 'OK':
+                        t += 1
+                        continue
+
+                    reachable[t] = True
+                    goal[t] = (abs(nxt[0] - env.end_position[0]) < stride_height and
+                               abs(nxt[1] - env.end_position[1]) < stride_wide)
+                    legs = [(leg_step, not goal[t])]   # reaching the goal resets the reward
+                    if goal[t]:
+                        statusE, leg_stepE, _ = env.directions_api(next_position, end_position)
+                        if statusE == 'OK':
+                            legs.append((leg_stepE, True))
+                    step_reward = 0.9 if goal[t] else -0.1
+                    for leg, scored in legs:
+                        for start, end, duration, dist, angle, speed, power in env.leg_segments(leg):
+                            seg_duration.append(duration)
+                            seg_power.append(power)
+                            seg_scored.append(scored)
+                            time[t] += duration
+                            distance[t] += dist
+                            energy[t] += int(duration) * power / 3600
+                            if scored:
+                                step_reward -= int(duration) * power / 3600 / 100000
+                    reward[t] = step_reward
+                    t += 1
+        seg_offset[n] = len(seg_duration)
+
+        arrays = {
+            'reachable': reachable, 'goal': goal, 'time': time, 'distance': distance,
+            'energy': energy, 'reward': reward, 'seg_offset': seg_offset,
+            'seg_duration': np.array(seg_duration, dtype=np.float64),
+            'seg_power': np.array(seg_power, dtype=np.float64),
+            'seg_scored': np.array(seg_scored, dtype=bool),
+        }
+        return cls((lat0, lng0), (stride_height, stride_wide), row_min, col_min, shape, arrays)
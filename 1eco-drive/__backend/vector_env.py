@@ -0,0 +1,87 @@
+import copy
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from battery import lithium_ion_battery
+
+class vector_environment():
+    # N independent environments stepped in lockstep: `env` itself plus N-1 copies.
+    # The copies share the map, the route and the API caches but each has its own
+    # battery, position and counters. Live steps are I/O bound, so they run on a
+    # thread pool; in tabular mode (env.use_table) they are plain array lookups.
+    # With max_step, a copy that has not reached the goal after that many stored
+    # steps is started over, like main.py ends a failed episode of `env`.
+    def __init__(self, env, num_envs, workers=None, max_step=None):
+        self.envs = [env] + [self.clone(env) for _ in range(num_envs - 1)]
+        self.num_envs = num_envs
+        self.max_step = max_step
+        self.steps = [0] * num_envs   # stored steps since each environment was last started over
+        self.workers = num_envs if workers is None else workers
+        self.pool = ThreadPoolExecutor(self.workers) if self.workers > 1 and env.table is None else None
+        self.rng = np.random.default_rng()
+
+    @staticmethod
+    def clone(env):
+        twin = copy.copy(env)
+        twin.battery = lithium_ion_battery(env.battery.total_capacity)
+        twin.current_position = env.start_position
+        twin.charge_num = 0
+        twin.unreach_position_num = 0
+        twin.time = 0
+        return twin
+
+    def states(self):  # [N, 2] current (lat, lng) of every environment
+        return np.array([env.current_position for env in self.envs], dtype=np.float32)
+
+    def reset(self, i):
+        env = self.envs[i]
+        env.current_position = env.start_position
+        env.battery_charge()
+        env.charge_num = 0
+        env.unreach_position_num = 0
+        env.time = 0
+        self.steps[i] = 0
+
+    def reset_twins(self):  # start every copy over, e.g. when a new episode of env begins
+        for i in range(1, self.num_envs):
+            self.reset(i)
+
+    def act(self, sess, Qnet, e):  # 3 output: states [N, 2], actions [N], explored [N]
+        # epsilon-greedy actions for every environment; all greedy ones come from one forward pass
+        states = self.states()
+        explore = self.rng.random(self.num_envs) < e
+        actions = self.rng.integers(0, 4, size=self.num_envs)
+        if not explore.all():
+            greedy = sess.run(Qnet.predict, feed_dict={Qnet.input: states})
+            actions = np.where(explore, actions, greedy)
+        return states, actions, explore
+
+    def step(self, actions):  # env.step output (s', r, d, charge_num, SOC) for every environment
+        actions = [int(a) for a in actions]
+        if self.pool is not None:
+            return list(self.pool.map(lambda pair: pair[0].step(pair[1]), zip(self.envs, actions)))
+        return [env.step(a) for env, a in zip(self.envs, actions)]
+
+    def store(self, replay_buffer, states, actions, results, first=0):
+        # append the transitions of environments first.. to the buffer and start
+        # finished ones (goal reached or max_step stored steps) over from the origin.
+        # returns the number of stored transitions
+        stored = 0
+        for i in range(first, self.num_envs):
+            s1, r, d, _, _ = results[i]
+            if self.envs[i].status_dir_check != 'OVER_QUERY_LIMIT':
+                replay_buffer.append(states[i], actions[i], r, s1, d)
+                stored += 1
+                self.steps[i] += 1
+            if d or (self.max_step is not None and self.steps[i] >= self.max_step):
+                self.reset(i)
+        return stored
+
+    def collect(self, sess, Qnet, e, replay_buffer):
+        # one lockstep step of every environment straight into the replay buffer
+        states, actions, _ = self.act(sess, Qnet, e)
+        results = self.step(actions)
+        return self.store(replay_buffer, states, actions, results)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()